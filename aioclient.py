@@ -0,0 +1,453 @@
+import os
+import re
+import time
+import zlib
+import asyncio
+import threading
+from core import FTPError, BufferPolicy, TransferProgress, parse_reply, reply_end, connection_lost
+from core import ListingReader, parse_features, parse_mlst, mlst_facts, deflate_commands, deflate_accepted
+from core import hash_method, hash_commands, hash_result, new_hash, hash_file, file_digest, parse_digest, same_digest
+from core import transfer_hash, digest_detail, sidecar_path, local_sidecar, resume_plan, reply_size, PREFIX_DIFFERS
+from core import DEFAULT_DEFLATE_LEVEL, ListingCache, DEFAULT_LIST_TTL
+from session import FTPSession
+
+
+class AsyncFTP(object):
+    timeout = 10
+
+    def __init__(self, server_info, trans_method=0, debug=None, info=None):
+        self.server_info = server_info
+        self.trans_method = trans_method
+        self.debug = debug
+        self.info = info
+        self.buffer_policy = BufferPolicy.from_profile(server_info)
+        self.remote_dir = '/'
+        self.stop = False
+        self.features = {}
+        self.reply_lines = []
+        self.last_digest = None
+        self.compressing = False
+        self.reader = None
+        self.writer = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(
+            self.server_info['hostname'], self.server_info['port']), self.timeout)
+        _, _ = await self.read_reply([220])
+        code, _ = await self.command('USER {0}'.format(self.server_info['username']), [230, 331])
+        if code == 331:
+            _, _ = await self.command('PASS {0}'.format(self.server_info['password']), [230])
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        _, _ = await self.command('SYST', [215])
+        self.buffer_policy.add_rtt(loop.time() - start)
+        _, _ = await self.command('TYPE I', [200])
+        try:
+            _, _ = await self.command('FEAT', [211])
+            self.features = parse_features(self.reply_lines)
+            if mlst_facts(self.features):
+                _, _ = await self.command('OPTS MLST {0}'.format(mlst_facts(self.features)), [200])
+        except FTPError:
+            self.features = {}
+        await self.negotiate_mode()
+
+    async def negotiate_mode(self):
+        self.compressing = deflate_accepted(await self.pipeline(deflate_commands(self.server_info, self.features)))
+
+    def notify(self, text):
+        if self.info:
+            self.info(text)
+
+    async def close(self):
+        if self.writer is None:
+            return
+        try:
+            self.writer.write('QUIT\r\n'.encode('utf-8'))
+            await asyncio.wait_for(self.writer.drain(), self.timeout)
+        except (OSError, asyncio.TimeoutError):
+            pass
+        self.writer.close()
+        self.writer = None
+
+    async def read_line(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise FTPError(421, 'Connection closed by server')
+        return line.decode('utf-8', 'replace').rstrip('\r\n')
+
+    async def read_reply(self, expect_code=None):
+        line = await self.read_line()
+        lines = [line]
+        end = reply_end(line)
+        while end and not (line + ' ').startswith(end):
+            line = await self.read_line()
+            lines.append(line)
+        self.reply_lines = lines
+        code, detail = parse_reply(line)
+        if expect_code and (code not in expect_code):
+            raise FTPError(code, detail)
+        if self.debug:
+            self.debug('{0} {1}'.format(code, detail))
+        return code, detail
+
+    async def command(self, line, expect_code=None):
+        if self.writer is None:
+            raise FTPError(421, 'Not connected')
+        self.writer.write('{0}\r\n'.format(line).encode('utf-8'))
+        await self.writer.drain()
+        return await self.read_reply(expect_code)
+
+    async def pipeline(self, commands, depth=64):
+        results = []
+        for start in range(0, len(commands), depth):
+            batch = commands[start:start + depth]
+            self.writer.write(''.join('{0}\r\n'.format(line) for line, _ in batch).encode('utf-8'))
+            await self.writer.drain()
+            for _, expect_code in batch:
+                try:
+                    results.append(await self.read_reply(expect_code))
+                except FTPError as e:
+                    if connection_lost(e):
+                        raise
+                    results.append(e)
+        return results
+
+    async def open_data(self, command):
+        if self.trans_method:
+            accepted = asyncio.get_running_loop().create_future()
+
+            def on_connect(reader, writer):
+                if accepted.done():
+                    writer.close()
+                else:
+                    accepted.set_result((reader, writer))
+
+            addr = self.writer.get_extra_info('sockname')[0]
+            server = await asyncio.start_server(on_connect, addr, 0)
+            try:
+                port = server.sockets[0].getsockname()[1]
+                _, _ = await self.command('PORT {0},{1},{2}'.format(
+                    addr.replace('.', ','), port // 256, port % 256), [200])
+                _, _ = await self.command(command, [125, 150])
+                return await asyncio.wait_for(accepted, self.timeout)
+            finally:
+                server.close()
+
+        _, addr_str = await self.command('PASV', [227])
+        res = re.search(r'(\d*),(\d*),(\d*),(\d*),(\d*),(\d*)', addr_str)
+        addr = [int(res.group(i)) for i in range(1, 7)]
+        data = await asyncio.wait_for(asyncio.open_connection(
+            '{0}.{1}.{2}.{3}'.format(*addr[:4]), addr[4] * 256 + addr[5]), self.timeout)
+        _, _ = await self.command(command, [125, 150])
+        return data
+
+    async def pwd(self):
+        _, detail = await self.command('PWD', [257])
+        self.remote_dir = re.match(r'"(.*)"', detail).group(1)
+        return self.remote_dir
+
+    async def list_dir(self, path=None, deliver=None):
+        mlsd = 'MLST' in self.features
+        command = 'MLSD' if mlsd else 'LIST'
+        reader, writer = await self.open_data('{0} {1}'.format(command, path) if path else command)
+        listing = ListingReader(mlsd, deliver)
+        inflate = zlib.decompressobj() if self.compressing else None
+        try:
+            while True:
+                chunk = await reader.read(self.buffer_policy.size)
+                if not chunk:
+                    break
+                listing.feed(inflate.decompress(chunk) if inflate else chunk)
+            if inflate:
+                listing.feed(inflate.flush())
+        finally:
+            writer.close()
+        entries = listing.close()
+        _, _ = await self.read_reply([226])
+        return entries
+
+    async def stat_entry(self, path):
+        if 'MLST' not in self.features:
+            return None
+        _, _ = await self.command('MLST {0}'.format(path), [250])
+        return parse_mlst(self.reply_lines)
+
+    async def remote_size(self, path):
+        return reply_size((await self.pipeline([('SIZE {0}'.format(path), [213])]))[0])
+
+    async def remote_digest(self, path, length=None):
+        method = hash_method(self.features)
+        if method is None:
+            return None
+        return hash_result(method, await self.pipeline(hash_commands(method, path, length)))
+
+    async def prefix_matches(self, local_path, remote_path, length):
+        remote = await self.remote_digest(remote_path, length) if length else None
+        if remote is None:
+            return None
+        local = await asyncio.get_running_loop().run_in_executor(None, file_digest, local_path, remote[0], length)
+        return same_digest(remote[1], local)
+
+    async def resume_offset(self, local_path, remote_path, offset, upload):
+        offset, reason = resume_plan(local_path, await self.remote_size(remote_path), offset, upload)
+        if offset and await self.prefix_matches(local_path, remote_path, offset) is False:
+            offset, reason = 0, PREFIX_DIFFERS
+        if reason:
+            self.notify(reason)
+        return offset
+
+    async def start_digest(self, local_path, offset):
+        algo = transfer_hash(self.server_info, self.features)
+        if not algo:
+            return None, None
+        digest = new_hash(algo)
+        if offset:
+            await asyncio.get_running_loop().run_in_executor(None, hash_file, digest, local_path, offset)
+        return algo, digest
+
+    async def remote_sidecar(self, path, algo):
+        path = sidecar_path(path, algo)
+        if await self.remote_size(path) is None:
+            return None
+        reader, writer = await self.open_data('RETR {0}'.format(path))
+        try:
+            data = await reader.read()
+        finally:
+            writer.close()
+        _, _ = await self.read_reply([226])
+        if self.compressing:
+            data = zlib.decompress(data)
+        return parse_digest(data.decode('ascii', 'replace'))
+
+    async def check_digest(self, detail, algo, value, local_path, remote_path, upload):
+        self.last_digest = (algo, value)
+        verify = self.server_info.get('verify')
+        expected = None
+        if verify == 'server':
+            remote = await self.remote_digest(remote_path)
+            if remote and remote[0] == algo:
+                expected = remote[1]
+        elif verify == 'sidecar':
+            expected = local_sidecar(local_path, algo) if upload else await self.remote_sidecar(remote_path, algo)
+        if verify and not expected:
+            self.notify('{0} not verified, no {1} digest to compare with'.format(remote_path, algo))
+        return digest_detail(detail, algo, value, expected, verify, remote_path)
+
+    async def abort_data(self, writer, error):
+        writer.close()
+        if not connection_lost(error):
+            await self.read_reply()
+
+    async def retrieve(self, local_path, remote_path, size, offset=0, report=None):
+        algo, digest = await self.start_digest(local_path, offset)
+        created = not os.path.exists(local_path)
+        f = open(local_path, 'wb' if created else 'r+b')
+        with f:
+            try:
+                if offset:
+                    _, _ = await self.command('REST {0}'.format(offset), [350])
+                reader, writer = await self.open_data('RETR {0}'.format(remote_path))
+            except (OSError, asyncio.TimeoutError, FTPError):
+                f.close()
+                if created:
+                    os.remove(local_path)
+                raise
+            policy = self.buffer_policy
+            policy.start()
+            progress = TransferProgress(report, size, offset) if report else None
+            inflate = zlib.decompressobj() if self.compressing else None
+            complete = True
+            try:
+                f.seek(offset)
+                f.truncate()
+                while True:
+                    if self.stop:
+                        self.stop = False
+                        complete = False
+                        break
+                    chunk = await reader.read(policy.size)
+                    data = chunk
+                    if inflate:
+                        data = inflate.decompress(chunk) if chunk else inflate.flush()
+                    f.write(data)
+                    if digest:
+                        digest.update(data)
+                    if progress and data:
+                        progress.update(len(data))
+                    if not chunk:
+                        break
+                    policy.record(len(chunk))
+                if progress:
+                    progress.finish()
+            except OSError as e:
+                await self.abort_data(writer, e)
+                raise
+            writer.close()
+        code, detail = await self.read_reply([226])
+        if digest and complete:
+            detail = await self.check_digest(detail, algo, digest.hexdigest(), local_path, remote_path, False)
+        return code, detail
+
+    async def store(self, local_path, remote_path, size, offset=0, report=None):
+        algo, digest = await self.start_digest(local_path, offset)
+        command = 'APPE' if offset else 'STOR'
+        with open(local_path, 'rb') as f:
+            reader, writer = await self.open_data('{0} {1}'.format(command, remote_path))
+            loop = asyncio.get_running_loop()
+            policy = self.buffer_policy
+            policy.start()
+            progress = TransferProgress(report, size, offset) if report else None
+            deflate = None
+            if self.compressing:
+                deflate = zlib.compressobj(self.server_info.get('compress_level', DEFAULT_DEFLATE_LEVEL))
+            pos = offset
+            complete = True
+            try:
+                f.seek(offset)
+                while True:
+                    if self.stop:
+                        self.stop = False
+                        complete = False
+                        break
+                    if digest or deflate:
+                        # hashing and deflating need the data read, so no sendfile
+                        data = f.read(policy.size)
+                        if digest:
+                            digest.update(data)
+                        if deflate:
+                            writer.write(deflate.compress(data) if data else deflate.flush())
+                        elif data:
+                            writer.write(data)
+                        await writer.drain()
+                        sent = len(data)
+                    else:
+                        sent = await loop.sendfile(writer.transport, f, pos, policy.size)
+                    if not sent:
+                        break
+                    pos += sent
+                    policy.record(sent)
+                    if progress:
+                        progress.update(sent)
+                if progress:
+                    progress.finish()
+            except OSError as e:
+                await self.abort_data(writer, e)
+                raise
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+        code, detail = await self.read_reply([226])
+        if digest and complete:
+            detail = await self.check_digest(detail, algo, digest.hexdigest(), local_path, remote_path, True)
+        return code, detail
+
+    async def read_range(self, local_path, remote_path, start, end, received, stopped):
+        # FTPSession.read_range over this connection
+        pos = start
+        _, _ = await self.command('REST {0}'.format(pos), [350])
+        reader, writer = await self.open_data('RETR {0}'.format(remote_path))
+        try:
+            with open(local_path, 'r+b') as f:
+                f.seek(pos)
+                while pos < end and not stopped():
+                    chunk = await reader.read(min(self.buffer_policy.size, end - pos))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    pos += len(chunk)
+                    received(len(chunk))
+        except OSError as e:
+            await self.abort_data(writer, e)
+            raise
+        writer.close()
+        _, _ = await self.read_reply()
+        if pos < end and not stopped():
+            raise FTPError(0, 'data connection closed at byte {0}'.format(pos))
+
+
+loop = None
+loop_lock = threading.Lock()
+
+
+def event_loop():
+    # the loop every AsyncSession runs on, started on first use
+    global loop
+    with loop_lock:
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+        return loop
+
+
+class AsyncSession(FTPSession):
+    # FTPSession whose connection is an AsyncFTP on the shared event loop, for
+    # blocking callers such as the GUI's control thread; everything above the
+    # I/O is FTPSession's own
+    ftp = None
+
+    @property
+    def stop(self):
+        return self.ftp is not None and self.ftp.stop
+
+    @stop.setter
+    def stop(self, value):
+        if self.ftp is not None:
+            self.ftp.stop = value
+
+    def run(self, coro):
+        try:
+            return asyncio.run_coroutine_threadsafe(coro, event_loop()).result()
+        finally:
+            self.last_used = time.monotonic()
+
+    def open_ctrl(self, server_info, trans_method):
+        self.server_info = server_info
+        self.trans_method = trans_method
+        self.list_cache = ListingCache(server_info.get('list_ttl', DEFAULT_LIST_TTL))
+        self.ftp = AsyncFTP(server_info, trans_method, self.log, self.notify)
+        self.buffer_policy = self.ftp.buffer_policy
+        self.run(self.ftp.open())
+        self.features = self.ftp.features
+        self.compressing = self.ftp.compressing
+
+    def close_ctrl(self):
+        if self.ftp is not None:
+            self.run(self.ftp.close())
+
+    def send_command(self, line, expect_code=None):
+        return self.run(self.ftp.command(line, expect_code))
+
+    def pipeline(self, commands):
+        return self.run(self.ftp.pipeline(commands))
+
+    def list_dir(self, path=None, deliver=None):
+        return self.run(self.ftp.list_dir(path, deliver))
+
+    def stat_entry(self, path):
+        return self.run(self.ftp.stat_entry(path))
+
+    def resume_offset(self, local_path, remote_path, offset, upload):
+        return self.run(self.ftp.resume_offset(local_path, remote_path, offset, upload))
+
+    def retrieve(self, local_path, remote_path, size, offset=0):
+        try:
+            return self.run(self.ftp.retrieve(local_path, remote_path, size, offset, self.report))
+        finally:
+            self.last_digest = self.ftp.last_digest
+
+    def store(self, local_path, remote_path, size, offset=0):
+        try:
+            return self.run(self.ftp.store(local_path, remote_path, size, offset, self.report))
+        finally:
+            self.last_digest = self.ftp.last_digest
+
+    def check_digest(self, detail, algo, value, local_path, remote_path, upload):
+        try:
+            return self.run(self.ftp.check_digest(detail, algo, value, local_path, remote_path, upload))
+        finally:
+            self.last_digest = self.ftp.last_digest
+
+    def read_range(self, local_path, remote_path, start, end, buf, received, stopped):
+        self.run(self.ftp.read_range(local_path, remote_path, start, end, received, stopped))
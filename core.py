@@ -0,0 +1,647 @@
+import re
+import socket
+import time
+import os
+import zlib
+import hashlib
+import calendar
+import posixpath
+from collections import namedtuple
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+# transfer chunk size limits, see BufferPolicy
+DEFAULT_BUFSIZE = 256 * 1024
+MIN_BUFSIZE = 16 * 1024
+MAX_BUFSIZE = 16 * 1024 * 1024
+# seconds a cached directory listing stays valid
+DEFAULT_LIST_TTL = 60
+# seconds of mtime difference still treated as equal (FAT, MDTM granularity)
+MTIME_TOLERANCE = 2
+# listing rows handed out per batch, and at least this often (seconds)
+LIST_BATCH = 1000
+LIST_BATCH_INTERVAL = 0.1
+# zlib level of MODE Z transfers; 1 is the fastest and gets most of the gain on text
+DEFAULT_DEFLATE_LEVEL = 1
+
+
+class FTPError(Exception):
+    def __init__(self, code, detail):
+        self.code = code
+        self.detail = detail
+
+    def __str__(self):
+        return '%d: %s' % (self.code, self.detail)
+
+
+def parse_reply(line):
+    res = re.match(r'^(\d{3})(?: (.*))?$', line)
+    if not res:
+        return -1, line
+    return int(res.group(1)), res.group(2) or ''
+
+
+def reply_end(line):
+    # the first line of a multi-line reply is 'xyz-', the last one 'xyz '
+    if re.match(r'^\d{3}-', line):
+        return line[:3] + ' '
+    return None
+
+
+# type is 'dir', 'file' or 'link'; size and modify (UTC seconds) may be None
+RemoteEntry = namedtuple('RemoteEntry', 'name type size modify perm owner')
+
+
+def parse_features(lines):
+    features = {}
+    for line in lines[1:-1]:
+        name, _, params = line.strip().partition(' ')
+        if name:
+            features[name.upper()] = params
+    return features
+
+
+def mlst_facts(features):
+    # the facts to ask for with OPTS MLST, out of those the server offers
+    offered = [fact.rstrip('*').lower() for fact in features.get('MLST', '').split(';') if fact]
+    wanted = ['type', 'size', 'modify', 'perm', 'unix.owner', 'unix.uid', 'unix.group', 'unix.gid']
+    return ''.join(fact + ';' for fact in wanted if fact in offered)
+
+
+def deflate_offered(features):
+    # FEAT lists 'MODE Z' when the server can deflate the data connection
+    return 'Z' in features.get('MODE', '').upper().split()
+
+
+def deflate_commands(server_info, features):
+    # MODE Z when the profile asks for it and the server offers it; the level
+    # is only a hint, so a failed OPTS leaves MODE Z to go ahead
+    if not server_info.get('compress') or not deflate_offered(features):
+        return []
+    level = server_info.get('compress_level', DEFAULT_DEFLATE_LEVEL)
+    return [('OPTS MODE Z LEVEL {0}'.format(level), [200]), ('MODE Z', [200])]
+
+
+def deflate_accepted(results):
+    # whether the pipelined deflate_commands switched the data connections over
+    return bool(results) and not isinstance(results[-1], FTPError)
+
+
+# server-side checksum algorithms, as named by HASH and by the X* commands
+HASH_ALGORITHMS = {'SHA-256': 'sha256', 'SHA-1': 'sha1', 'MD5': 'md5', 'CRC32': 'crc32'}
+HASH_COMMANDS = [('XSHA256', 'sha256'), ('XSHA1', 'sha1'), ('XSHA', 'sha1'), ('XMD5', 'md5'), ('XCRC', 'crc32')]
+DEFAULT_VERIFY_HASH = 'sha256'
+
+
+def hash_method(features):
+    # (command, algorithm) able to hash a byte range on the server, or None
+    if 'HASH' in features and 'RANG' in features:
+        for name in features['HASH'].split(';'):
+            if name.endswith('*') and name.rstrip('*').upper() in HASH_ALGORITHMS:
+                return 'HASH', HASH_ALGORITHMS[name.rstrip('*').upper()]
+    for command, algo in HASH_COMMANDS:
+        if command in features:
+            return command, algo
+    return None
+
+
+class CRC32(object):
+    def __init__(self):
+        self.value = 0
+
+    def update(self, data):
+        self.value = zlib.crc32(data, self.value)
+
+    def hexdigest(self):
+        return '{0:08x}'.format(self.value)
+
+
+def new_hash(algo):
+    # crc32, the hashlib names, or xxh32/xxh64/xxh3_64/xxh128 with xxhash installed
+    if algo == 'crc32':
+        return CRC32()
+    if algo.startswith('xxh'):
+        if xxhash is None or not hasattr(xxhash, algo):
+            raise FTPError(504, '{0} needs the xxhash module'.format(algo))
+        return getattr(xxhash, algo)()
+    return hashlib.new(algo)
+
+
+def hash_file(digest, path, length, bufsize=DEFAULT_BUFSIZE):
+    # feeds the first length bytes of path into digest
+    with open(path, 'rb') as f:
+        while length > 0:
+            data = f.read(min(bufsize, length))
+            if not data:
+                break
+            digest.update(data)
+            length -= len(data)
+    return digest
+
+
+def file_digest(path, algo, length, bufsize=DEFAULT_BUFSIZE):
+    return hash_file(new_hash(algo), path, length, bufsize).hexdigest()
+
+
+def hash_commands(method, path, length=None):
+    # commands asking the server for the digest of path, or of its first
+    # length bytes; the digest is in the reply to the last one
+    command, _ = method
+    if command == 'HASH':
+        rang = [('RANG 0 {0}'.format(length - 1), [350])] if length else []
+        return rang + [('HASH {0}'.format(path), [213])]
+    if length:
+        return [('{0} {1} 0 {2}'.format(command, path, length), [213, 250])]
+    return [('{0} {1}'.format(command, path), [213, 250])]
+
+
+def hash_result(method, results):
+    # (algorithm, digest) out of the pipelined hash_commands, or None when the
+    # server refused any of them
+    if not results or any(isinstance(result, FTPError) for result in results):
+        return None
+    if method[0] == 'HASH':
+        digest = parse_hash_reply(results[-1][1])
+    else:
+        digest = parse_digest(results[-1][1])
+    return (method[1], digest) if digest else None
+
+
+def transfer_hash(server_info, features):
+    # algorithm to hash transfers with while the data passes, or None; verifying
+    # against the server needs the algorithm the server hashes with
+    if server_info.get('verify') == 'server' and hash_method(features):
+        return hash_method(features)[1]
+    if server_info.get('verify') and not server_info.get('checksum'):
+        return DEFAULT_VERIFY_HASH
+    return server_info.get('checksum')
+
+
+def sidecar_path(path, algo):
+    # checksum file published next to path, as written by md5sum/sha256sum
+    return '{0}.{1}'.format(path, algo)
+
+
+def local_sidecar(path, algo):
+    try:
+        with open(sidecar_path(path, algo), 'rb') as f:
+            return parse_digest(f.read(4096).decode('ascii', 'replace'))
+    except OSError:
+        return None
+
+
+def parse_digest(detail):
+    match = re.search(r'\b([0-9a-fA-F]{8,})\b', detail)
+    return match.group(1) if match else None
+
+
+def parse_hash_reply(detail):
+    # a HASH reply is "<algorithm> <start>-<end> <digest> <path>"; the range
+    # end is as hex-looking as the digest, so go by position
+    fields = detail.split(' ', 3)
+    if len(fields) < 3 or not re.match(r'\d+-\d+$', fields[1]):
+        return None
+    return fields[2] if re.match(r'[0-9a-fA-F]+$', fields[2]) else None
+
+
+def same_digest(a, b):
+    # servers differ in case and in zero padding of CRCs
+    return int(a, 16) == int(b, 16)
+
+
+def digest_detail(detail, algo, value, expected, verify, path):
+    # the completion reply with the digest taken in flight appended; one that
+    # differs from the expected digest fails the transfer
+    if expected and not same_digest(expected, value):
+        raise FTPError(451, '{0} mismatch for {1}: {2} expected, {3} transferred'.format(
+            algo, path, expected, value))
+    detail = '{0} ({1} {2})'.format(detail, algo, value)
+    if verify and not expected:
+        return detail + ', not verified'
+    return detail + (', verified' if verify else '')
+
+
+def resume_plan(local_path, remote_size, offset, upload):
+    # (offset, reason): where a resumed transfer picks up, or 0 and why it
+    # has to restart; uploads resume at the size already on the server
+    local_size = os.path.getsize(local_path) if os.path.exists(local_path) else 0
+    if upload:
+        offset, limit = (offset if remote_size is None else remote_size), local_size
+    else:
+        offset, limit = local_size, remote_size
+    if limit is not None and offset > limit:
+        return 0, 'Target is larger than source, restarting transfer'
+    return offset, None
+
+
+PREFIX_DIFFERS = 'Existing data differs from source, restarting transfer'
+
+
+def reply_size(result):
+    # a pipelined SIZE reply as a number, None when the server cannot tell
+    if isinstance(result, FTPError):
+        return None
+    try:
+        return int(result[1])
+    except ValueError:
+        return None
+
+
+def parse_mlst(lines):
+    # the entry in an MLST reply, named like an MLSD entry
+    for line in lines[1:-1]:
+        entry = parse_mlsd_line(line.lstrip(' '))
+        if entry:
+            return entry._replace(name=entry.name.rstrip('/').rsplit('/', 1)[-1])
+    return None
+
+
+def parse_mdtm(value):
+    # YYYYMMDDHHMMSS[.sss] in UTC, as used by MDTM and the MLSD modify fact
+    try:
+        return calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S'))
+    except ValueError:
+        return None
+
+
+def parse_mlsd_line(line):
+    facts, _, name = line.partition(' ')
+    if not name:
+        return None
+    fact = {}
+    for item in facts.split(';'):
+        key, _, value = item.partition('=')
+        if key:
+            fact[key.lower()] = value
+    kind = fact.get('type', '').lower()
+    if kind in ('cdir', 'pdir'):
+        return None
+    if kind == 'dir':
+        kind = 'dir'
+    elif 'link' in kind:
+        kind = 'link'
+    else:
+        kind = 'file'
+    try:
+        size = int(fact.get('size', fact.get('sizd')))
+    except (TypeError, ValueError):
+        size = None
+    modify = parse_mdtm(fact.get('modify', ''))
+    owner = '/'.join(fact.get(name, fact.get(number)) for name, number in
+                     (('unix.owner', 'unix.uid'), ('unix.group', 'unix.gid'))
+                     if name in fact or number in fact)
+    return RemoteEntry(name, kind, size, modify, fact.get('perm', ''), owner)
+
+
+def parse_list_time(month, day, year_or_time):
+    try:
+        if ':' in year_or_time:
+            year = time.gmtime().tm_year
+            stamp = calendar.timegm(time.strptime('{0} {1} {2} {3}'.format(month, day, year, year_or_time), '%b %d %Y %H:%M'))
+            # LIST omits the year for the last six months only
+            if stamp > time.time() + 86400:
+                stamp = calendar.timegm(time.strptime('{0} {1} {2} {3}'.format(month, day, year - 1, year_or_time), '%b %d %Y %H:%M'))
+            return stamp
+        return calendar.timegm(time.strptime('{0} {1} {2}'.format(month, day, year_or_time), '%b %d %Y'))
+    except ValueError:
+        return None
+
+
+def parse_list_line(line):
+    fields = line.split(maxsplit=8)
+    if len(fields) != 9 or fields[0][0] not in '-dl':
+        return None
+    mode, name = fields[0], fields[8]
+    if mode[0] == 'd':
+        kind = 'dir'
+    elif mode[0] == 'l':
+        kind = 'link'
+        name = name.split(' -> ')[0]
+    else:
+        kind = 'file'
+    try:
+        size = int(fields[4])
+    except ValueError:
+        size = None
+    return RemoteEntry(name, kind, size, parse_list_time(*fields[5:8]), mode[1:], '{0}/{1}'.format(fields[2], fields[3]))
+
+
+def parse_listing(lines, mlsd):
+    parse = parse_mlsd_line if mlsd else parse_list_line
+    entries = []
+    for line in lines:
+        entry = parse(line)
+        if entry and entry.name not in ('.', '..'):
+            entries.append(entry)
+    return entries
+
+
+class ListingReader(object):
+    # parses MLSD/LIST data as it arrives; complete rows go to deliver in batches
+    def __init__(self, mlsd, deliver=None):
+        self.mlsd = mlsd
+        self.deliver = deliver
+        self.buffer = bytearray()
+        self.entries = []
+        self.pending = 0
+        self.last = time.monotonic()
+
+    def feed(self, data):
+        self.buffer += data
+        end = self.buffer.rfind(b'\n') + 1
+        if end:
+            self.add(self.buffer[:end])
+            del self.buffer[:end]
+
+    def add(self, data):
+        entries = parse_listing(data.decode('utf-8', 'replace').splitlines(), self.mlsd)
+        self.entries.extend(entries)
+        self.pending += len(entries)
+        now = time.monotonic()
+        if self.pending >= LIST_BATCH or now - self.last >= LIST_BATCH_INTERVAL:
+            self.flush(now)
+
+    def flush(self, now):
+        if self.deliver and self.pending:
+            self.deliver(self.entries[-self.pending:])
+        self.pending = 0
+        self.last = now
+
+    def close(self):
+        self.add(self.buffer)
+        self.buffer = bytearray()
+        self.flush(time.monotonic())
+        return self.entries
+
+
+def local_entry(dir_entry):
+    # one stat per entry; DirEntry caches it, broken links fall back to lstat
+    try:
+        st = dir_entry.stat()
+    except OSError:
+        st = dir_entry.stat(follow_symlinks=False)
+    try:
+        is_dir = dir_entry.is_dir()
+    except OSError:
+        is_dir = False
+    return RemoteEntry(dir_entry.name, 'dir' if is_dir else 'file', st.st_size, st.st_mtime, '', '')
+
+
+def scan_local(path):
+    with os.scandir(path) as it:
+        for dir_entry in it:
+            try:
+                yield local_entry(dir_entry)
+            except OSError:
+                pass
+
+
+def diff_listing(snapshot, entries):
+    # snapshot maps name to (is_dir, size, modify); returns (name, entry) changes
+    delta = []
+    seen = set()
+    for entry in entries:
+        seen.add(entry.name)
+        if snapshot.get(entry.name) != (entry.type == 'dir', entry.size, entry.modify):
+            delta.append((entry.name, entry))
+    delta += [(name, None) for name in snapshot if name not in seen]
+    return delta
+
+
+def walk_local(path):
+    # yields (relative posix path, entry) for every file below path
+    pending = ['']
+    seen = {os.path.realpath(path)}
+    while pending:
+        rel_dir = pending.pop()
+        for entry in scan_local(os.path.join(path, *rel_dir.split('/'))):
+            rel_path = posixpath.join(rel_dir, entry.name) if rel_dir else entry.name
+            if entry.type != 'dir':
+                yield rel_path, entry
+                continue
+            real = os.path.realpath(os.path.join(path, *rel_path.split('/')))
+            if real not in seen:
+                seen.add(real)
+                pending.append(rel_path)
+
+
+SyncAction = namedtuple('SyncAction', 'direction path size modify reason')
+
+
+def sync_plan(local, remote, direction):
+    # local and remote map relative paths to file entries; direction is
+    # 'get', 'put' or 'both'. Two-way sync moves the newer side; files whose
+    # times cannot be compared are reported as conflicts instead.
+    plan = []
+    for path in sorted(set(local) | set(remote)):
+        local_entry, remote_entry = local.get(path), remote.get(path)
+        if local_entry is None:
+            if direction != 'put':
+                plan.append(SyncAction('get', path, remote_entry.size, remote_entry.modify, 'missing locally'))
+            continue
+        if remote_entry is None:
+            if direction != 'get':
+                plan.append(SyncAction('put', path, local_entry.size, local_entry.modify, 'missing remotely'))
+            continue
+        newer = 0
+        timed = local_entry.modify is not None and remote_entry.modify is not None
+        if timed:
+            if local_entry.modify - remote_entry.modify > MTIME_TOLERANCE:
+                newer = 1
+            elif remote_entry.modify - local_entry.modify > MTIME_TOLERANCE:
+                newer = -1
+        same_size = local_entry.size == remote_entry.size
+        if direction == 'get' and (not same_size or newer < 0):
+            plan.append(SyncAction('get', path, remote_entry.size, remote_entry.modify,
+                                   'remote newer' if same_size else 'size differs'))
+        elif direction == 'put' and (not same_size or newer > 0):
+            plan.append(SyncAction('put', path, local_entry.size, local_entry.modify,
+                                   'local newer' if same_size else 'size differs'))
+        elif direction == 'both':
+            if newer > 0:
+                plan.append(SyncAction('put', path, local_entry.size, local_entry.modify, 'local newer'))
+            elif newer < 0:
+                plan.append(SyncAction('get', path, remote_entry.size, remote_entry.modify, 'remote newer'))
+            elif not timed:
+                plan.append(SyncAction('skip', path, None, None, 'conflict: no modification time to compare'))
+            elif not same_size:
+                plan.append(SyncAction('skip', path, None, None, 'conflict: sizes differ, same time'))
+    return plan
+
+
+def missing_parents(plan, remote_dirs):
+    # remote directories the uploads in plan need that are not in remote_dirs;
+    # shallow ones sort first, so every MKD finds its parent
+    parents = set()
+    for action in plan:
+        parent = posixpath.dirname(action.path)
+        while action.direction == 'put' and parent and parent not in remote_dirs:
+            parents.add(parent)
+            parent = posixpath.dirname(parent)
+    return sorted(parents, key=lambda path: (path.count('/'), path))
+
+
+def normalize_remote(path):
+    return posixpath.normpath('/' + path.lstrip('/'))
+
+
+class ListingCache(object):
+    def __init__(self, ttl=DEFAULT_LIST_TTL):
+        self.ttl = ttl
+        self.listings = {}
+
+    def get(self, path):
+        item = self.listings.get(normalize_remote(path))
+        if item is None or time.monotonic() - item[0] > self.ttl:
+            return None
+        return item[1]
+
+    def put(self, path, entries):
+        self.listings[normalize_remote(path)] = (time.monotonic(), entries)
+
+    def invalidate(self, path, parent=True):
+        # path itself changed: drop the listing of its parent and of its subtree
+        path = normalize_remote(path)
+        prefix = path.rstrip('/') + '/'
+        if parent:
+            self.listings.pop(posixpath.dirname(path), None)
+        for key in [key for key in self.listings if key == path or key.startswith(prefix)]:
+            del self.listings[key]
+
+    def lookup(self, path):
+        path = normalize_remote(path)
+        item = self.listings.get(posixpath.dirname(path))
+        name = posixpath.basename(path)
+        for entry in item[1] if item else []:
+            if entry.name == name:
+                return entry
+        return None
+
+    def apply(self, changes, current_dir):
+        # changes are (path, entry) pairs, entry None for a removed path;
+        # patches cached parents in place and returns the delta for current_dir
+        deltas = {}
+        for path, entry in changes:
+            path = normalize_remote(path)
+            parent, name = posixpath.split(path)
+            self.invalidate(path, parent=False)
+            deltas.setdefault(parent, []).append((name, entry and entry._replace(name=name)))
+        for parent, delta in deltas.items():
+            item = self.listings.get(parent)
+            if item:
+                self.listings[parent] = (item[0], patch_listing(item[1], delta))
+        return deltas.get(normalize_remote(current_dir), [])
+
+    def clear(self):
+        self.listings.clear()
+
+
+def patch_listing(entries, delta):
+    entries = dict((entry.name, entry) for entry in entries)
+    for name, entry in delta:
+        entries.pop(name, None)
+        if entry:
+            entries[name] = entry
+    return list(entries.values())
+
+
+def connection_lost(e):
+    # only failures of the connection itself; errors on local files are
+    # OSErrors as well and leave the session usable
+    if isinstance(e, FTPError):
+        return e.code == 421
+    return isinstance(e, (ConnectionError, socket.timeout, TimeoutError))
+
+
+class BufferPolicy(object):
+    # seconds of traffic measured before the chunk size is re-evaluated
+    tune_interval = 0.25
+    # seconds of transfer one chunk should represent, so stop requests and
+    # progress updates stay responsive at any speed
+    chunk_time = 0.05
+
+    def __init__(self, size=DEFAULT_BUFSIZE, auto_tune=True):
+        self.size = max(MIN_BUFSIZE, min(MAX_BUFSIZE, size))
+        self.auto_tune = auto_tune
+        self.rtt = None
+        self.throughput = None
+        self.window_bytes = 0
+        self.window_start = 0
+
+    @classmethod
+    def from_profile(cls, server_info):
+        return cls(server_info.get('buffer_size', DEFAULT_BUFSIZE),
+                   server_info.get('auto_tune', True))
+
+    def add_rtt(self, rtt):
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt = 0.875 * self.rtt + 0.125 * rtt
+
+    def start(self):
+        self.window_bytes = 0
+        self.window_start = time.monotonic()
+
+    def record(self, nbytes):
+        if not self.auto_tune:
+            return
+        self.window_bytes += nbytes
+        elapsed = time.monotonic() - self.window_start
+        if elapsed < self.tune_interval:
+            return
+        rate = self.window_bytes / elapsed
+        if self.throughput is None:
+            self.throughput = rate
+        else:
+            self.throughput = 0.5 * self.throughput + 0.5 * rate
+        target = self.throughput * self.chunk_time
+        if self.rtt:
+            # never go below one bandwidth-delay product
+            target = max(target, self.throughput * self.rtt)
+        target = 1 << (int(target) - 1).bit_length() if target >= 1 else 1
+        self.size = max(MIN_BUFSIZE, min(MAX_BUFSIZE, target))
+        self.start()
+
+
+class TransferProgress(object):
+    # seconds between two progress reports
+    interval = 0.1
+
+    def __init__(self, report, size, offset=0):
+        self.report = report
+        self.size = size
+        self.done = offset
+        self.start_done = offset
+        self.start_time = self.last_time = time.monotonic()
+        self.last_done = offset
+        self.speed = 0
+        self.emit(self.start_time)
+
+    def update(self, nbytes):
+        self.done += nbytes
+        now = time.monotonic()
+        if now - self.last_time >= self.interval:
+            self.emit(now)
+
+    def emit(self, now):
+        if now > self.last_time:
+            self.speed = (self.done - self.last_done) / (now - self.last_time)
+        elapsed = now - self.start_time
+        avg_speed = (self.done - self.start_done) / elapsed if elapsed else 0
+        remaining = max(self.size - self.done, 0)
+        self.report({
+            'done': self.done,
+            'size': self.size,
+            'speed': self.speed,
+            'avg_speed': avg_speed,
+            'eta': remaining / avg_speed if avg_speed else -1,
+            'finished': False
+        })
+        self.last_time = now
+        self.last_done = self.done
+
+    def finish(self):
+        self.emit(time.monotonic())
@@ -0,0 +1,93 @@
+import os
+import sys
+import time
+import argparse
+from core import FTPError
+from session import connect, close_pools
+
+
+def print_entry(entry, long_format):
+    if not long_format:
+        print(entry.name + ('/' if entry.type == 'dir' else ''))
+        return
+    modify = '' if entry.modify is None else time.strftime('%Y-%m-%d %H:%M', time.gmtime(entry.modify))
+    print('{0:<10} {1:>12} {2:<16} {3}'.format(entry.perm or entry.type, entry.size or 0, modify, entry.name))
+
+
+def run(session, args):
+    if args.command == 'ls':
+        for entry in sorted(session.list(args.path), key=lambda entry: (entry.type != 'dir', entry.name)):
+            print_entry(entry, args.long)
+    elif args.command == 'get':
+        _, detail = session.get(args.remote, args.local, args.resume, args.segments)
+        print(detail)
+    elif args.command == 'put':
+        _, detail = session.put(args.local, args.remote, args.resume)
+        print(detail)
+    elif args.command == 'mirror':
+        plan = session.mirror(args.local, args.remote, args.direction, args.dry_run, args.jobs)
+        for action in plan:
+            print('{0:<4} {1} ({2})'.format(action.direction, action.path, action.reason))
+        if not plan:
+            print('Nothing to transfer')
+
+
+def parser():
+    parser = argparse.ArgumentParser(prog='ftpclient', description='FTP client for scripts and cron jobs')
+    parser.add_argument('-H', '--host', required=True)
+    parser.add_argument('-P', '--port', type=int, default=21)
+    parser.add_argument('-u', '--user', default='anonymous')
+    parser.add_argument('-p', '--password', default=os.environ.get('FTP_PASSWORD', ''),
+                        help='defaults to $FTP_PASSWORD')
+    parser.add_argument('--active', action='store_true', help='PORT instead of PASV data connections')
+    parser.add_argument('--compress', action='store_true', help='MODE Z when the server offers it')
+    parser.add_argument('--compress-level', type=int, default=1)
+    parser.add_argument('--checksum', help='crc32, md5, sha256, xxh64, ...; --verify defaults to sha256')
+    parser.add_argument('--verify', choices=['server', 'sidecar'])
+    parser.add_argument('-v', '--verbose', action='store_true', help='print server replies')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    ls = commands.add_parser('ls', help='list a remote directory')
+    ls.add_argument('path', nargs='?')
+    ls.add_argument('-l', '--long', action='store_true')
+
+    get = commands.add_parser('get', help='download a file')
+    get.add_argument('remote')
+    get.add_argument('local', nargs='?')
+    get.add_argument('-c', '--resume', action='store_true')
+    get.add_argument('-s', '--segments', type=int, default=1, help='parallel connections')
+
+    put = commands.add_parser('put', help='upload a file')
+    put.add_argument('local')
+    put.add_argument('remote', nargs='?')
+    put.add_argument('-c', '--resume', action='store_true')
+
+    mirror = commands.add_parser('mirror', help='transfer what differs between two trees')
+    mirror.add_argument('remote')
+    mirror.add_argument('local')
+    mirror.add_argument('-d', '--direction', choices=['get', 'put', 'both'], default='get')
+    mirror.add_argument('-n', '--dry-run', action='store_true', help='only print the plan')
+    mirror.add_argument('-j', '--jobs', type=int, default=4, help='parallel connections')
+    return parser
+
+
+def main(argv=None):
+    args = parser().parse_args(argv)
+    report = lambda text: print(text, file=sys.stderr)
+    try:
+        with connect(args.host, args.port, args.user, args.password, not args.active,
+                     on_info=report, on_debug=report if args.verbose else None,
+                     compress=args.compress, compress_level=args.compress_level,
+                     checksum=args.checksum, verify=args.verify) as session:
+            run(session, args)
+    except (FTPError, OSError) as e:
+        print('ftpclient: {0}'.format(e), file=sys.stderr)
+        return 1
+    finally:
+        close_pools()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
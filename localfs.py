@@ -0,0 +1,53 @@
+import time
+from PyQt5.QtCore import QThread, pyqtSignal
+from core import LIST_BATCH, LIST_BATCH_INTERVAL, scan_local, diff_listing
+
+
+class LocalScanner(QThread):
+    # lists a local directory off the GUI thread; every signal carries the
+    # scan generation so results of a superseded scan can be dropped.
+    # Given a snapshot of the shown rows it only reports the difference.
+    entriesFound = pyqtSignal(int, list)
+    deltaFound = pyqtSignal(int, list)
+    scanFinished = pyqtSignal(int, str)
+
+    def __init__(self, parent, path, generation, snapshot=None):
+        self.path = path
+        self.generation = generation
+        self.snapshot = snapshot
+        self.cancelled = False
+        super(LocalScanner, self).__init__(parent=parent)
+        self.finished.connect(self.deleteLater)
+
+    def run(self):
+        if self.snapshot is not None:
+            try:
+                entries = list(scan_local(self.path))
+            except OSError as e:
+                self.scanFinished.emit(self.generation, str(e))
+                return
+            if not self.cancelled:
+                self.deltaFound.emit(self.generation, diff_listing(self.snapshot, entries))
+                self.scanFinished.emit(self.generation, '')
+            return
+        batch = []
+        last = time.monotonic()
+        try:
+            for entry in scan_local(self.path):
+                if self.cancelled:
+                    return
+                batch.append(entry)
+                now = time.monotonic()
+                if len(batch) >= LIST_BATCH or now - last >= LIST_BATCH_INTERVAL:
+                    self.entriesFound.emit(self.generation, batch)
+                    batch = []
+                    last = now
+        except OSError as e:
+            self.scanFinished.emit(self.generation, str(e))
+            return
+        if batch:
+            self.entriesFound.emit(self.generation, batch)
+        self.scanFinished.emit(self.generation, '')
+
+    def cancel(self):
+        self.cancelled = True
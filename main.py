@@ -9,6 +9,18 @@ from PyQt5.QtCore import *
 from PyQt5.QtGui import *
 import Ui_mainwindow
 from client import CtrlThread
+from session import close_pools
+from transfer import TransferQueue
+from models import IconCache, FileTableModel
+from localfs import LocalScanner
+
+def format_size(size):
+    for unit in ['B', 'KiB', 'MiB', 'GiB']:
+        if size < 1024:
+            return '{0:.1f} {1}'.format(size, unit)
+        size /= 1024
+    return '{0:.1f} TiB'.format(size)
+
 
 def exception_catcher(func):
     def wrapper(self, *args, **kwargs):
@@ -19,22 +31,168 @@ def exception_catcher(func):
     return wrapper
 
 
+class TransferWindow(QWidget):
+    def __init__(self, parent):
+        super(TransferWindow, self).__init__(parent, Qt.Window)
+        self.setWindowTitle('Transfers')
+        self.resize(640, 300)
+        self.model = QStandardItemModel(0, 5)
+        self.model.setHorizontalHeaderLabels(
+            ['Filename', 'Direction', 'Filesize', 'Progress', 'State'])
+        self.view = QTreeView(self)
+        self.view.setModel(self.model)
+        self.view.setRootIsDecorated(False)
+        self.view.setEditTriggers(QTreeView.NoEditTriggers)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.view)
+        self.rows = {}
+
+    def addJob(self, job):
+        row = [QStandardItem(i) for i in [job.name, 'Download' if job.direction == 'get' else 'Upload', str(job.size), '', job.state]]
+        self.rows[job.id] = row
+        self.model.appendRow(row)
+        self.show()
+
+    def updateJob(self, job):
+        row = self.rows.get(job.id)
+        if row:
+            row[3].setText('{0}%'.format(job.done * 100 // job.size if job.size else 100))
+            row[4].setText(job.state)
+
+    def clear(self):
+        self.rows = {}
+        self.model.removeRows(0, self.model.rowCount())
+
+
+class SyncWindow(QWidget):
+    def __init__(self, parent):
+        super(SyncWindow, self).__init__(parent, Qt.Window)
+        self.resize(640, 300)
+        self.view = QPlainTextEdit(self)
+        self.view.setReadOnly(True)
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(0, 0, 0, 0)
+        layout.addWidget(self.view)
+
+    def showPlan(self, plan, dry_run):
+        self.setWindowTitle('Synchronize (dry run)' if dry_run else 'Synchronize')
+        transfer = [action for action in plan if action.direction != 'skip']
+        lines = ['{0} files to transfer, {1} total'.format(
+            len(transfer), format_size(sum(action.size or 0 for action in transfer)))]
+        for action in plan:
+            lines.append('{0:<5} {1}  ({2})'.format(action.direction, action.path, action.reason))
+        self.view.setPlainText('\n'.join(lines))
+        self.show()
+
+
+# connection options saved with QSettings and read again at every connect;
+# a None option is stored as ''
+SETTINGS = [('compress', bool), ('compress_level', int), ('auto_tune', bool), ('checksum', str),
+            ('verify', str), ('segments', int), ('list_ttl', int), ('backend', str)]
+
+
+class SettingsDialog(QDialog):
+    # edits SETTINGS; changes apply from the next connect on
+    def __init__(self, parent):
+        super(SettingsDialog, self).__init__(parent)
+        self.setWindowTitle('Settings')
+        self.widgets = {
+            'compress': QCheckBox('Compress transfers (MODE Z) when the server offers it'),
+            'compress_level': QSpinBox(),
+            'auto_tune': QCheckBox('Tune the buffer size to the connection'),
+            'checksum': QComboBox(),
+            'verify': QComboBox(),
+            'segments': QSpinBox(),
+            'list_ttl': QSpinBox(),
+            'backend': QComboBox(),
+        }
+        self.widgets['compress_level'].setRange(1, 9)
+        self.widgets['checksum'].addItems(['', 'crc32', 'md5', 'sha1', 'sha256', 'xxh64'])
+        self.widgets['verify'].addItems(['', 'server', 'sidecar'])
+        self.widgets['segments'].setRange(1, 16)
+        self.widgets['list_ttl'].setRange(0, 3600)
+        self.widgets['list_ttl'].setSuffix(' s')
+        self.widgets['backend'].addItems(['thread', 'asyncio'])
+        layout = QFormLayout(self)
+        layout.addRow(self.widgets['compress'])
+        layout.addRow('Compression level', self.widgets['compress_level'])
+        layout.addRow(self.widgets['auto_tune'])
+        layout.addRow('Checksum', self.widgets['checksum'])
+        layout.addRow('Verify against', self.widgets['verify'])
+        layout.addRow('Download segments', self.widgets['segments'])
+        layout.addRow('Listing cache', self.widgets['list_ttl'])
+        layout.addRow('Backend', self.widgets['backend'])
+        buttons = QDialogButtonBox(QDialogButtonBox.Ok | QDialogButtonBox.Cancel)
+        buttons.accepted.connect(self.accept)
+        buttons.rejected.connect(self.reject)
+        layout.addRow(buttons)
+
+    def setValues(self, values):
+        for name, value in values.items():
+            widget = self.widgets[name]
+            if isinstance(widget, QCheckBox):
+                widget.setChecked(value)
+            elif isinstance(widget, QSpinBox):
+                widget.setValue(value)
+            else:
+                widget.setCurrentText(value or '')
+
+    def values(self):
+        values = {}
+        for name, widget in self.widgets.items():
+            if isinstance(widget, QCheckBox):
+                values[name] = widget.isChecked()
+            elif isinstance(widget, QSpinBox):
+                values[name] = widget.value()
+            else:
+                values[name] = widget.currentText() or None
+        return values
+
+
 class MainWindow(QMainWindow):
     remotedirChanged = pyqtSignal(str)
     getFile = pyqtSignal(str, str, int)
     restFile = pyqtSignal(str, str, int, int)
+    segFile = pyqtSignal(str, str, int, int)
     putFile = pyqtSignal(str, str, int)
     appeFile = pyqtSignal(str, str, int, int)
     delFile = pyqtSignal(str)
     rmDir = pyqtSignal(str)
+    removePaths = pyqtSignal(list, list)
+    refreshRemote = pyqtSignal()
     mkDir = pyqtSignal(str)
     rename = pyqtSignal(str, str)
     clientThread = None
+    transferQueue = None
     local_dir = None
     remote_dir = None
+    transfer_name = None
+    localScanner = None
+    local_scan = 0
+    local_batches = 0
+    buffer_size = 256 * 1024
+    auto_tune = True
+    segments = 4
+    segment_size = 32 * 1024 * 1024
+    list_ttl = 60
+    # algorithm transfers are hashed with as the data passes: crc32, md5,
+    # sha256, xxh64 (with xxhash) or None
+    checksum = None
+    # None, 'server' (HASH/X* commands) or 'sidecar' (<file>.<algorithm> next to the source)
+    verify = None
+    # deflate data connections (MODE Z) when the server offers it; level 1-9
+    compress = False
+    compress_level = 1
+    # ms of quiet after a local change before the local pane is re-read
+    local_refresh_delay = 300
+    transfer_workers = 4
+    # 'thread' talks to the server over blocking sockets, 'asyncio' over the event loop engine
+    backend = 'thread'
 
     def init(self, ui):
         self.ui = ui
+        self.icons = IconCache()
 
         self.progressBar = QProgressBar()
         self.progressBar.setGeometry(0, 0, 100, 15)
@@ -43,28 +201,38 @@ class MainWindow(QMainWindow):
         self.progressBar.hide()
         self.ui.statusbar.addPermanentWidget(self.progressBar)
 
+        self.transferWindow = TransferWindow(self)
+        self.syncWindow = SyncWindow(self)
+
         self.trans_method = QButtonGroup()
         self.trans_method.addButton(ui.portButton, 1)
         self.trans_method.addButton(ui.pasvButton, 0)
 
+        # the local pane follows changes in local_dir, debounced
+        self.localWatcher = QFileSystemWatcher(self)
+        self.localWatcher.directoryChanged.connect(self.localChanged)
+        self.localTimer = QTimer(self)
+        self.localTimer.setSingleShot(True)
+        self.localTimer.setInterval(self.local_refresh_delay)
+        self.localTimer.timeout.connect(self.diffLocalList)
+
         # init localView
-        self.localModel = QStandardItemModel(0, 4)
-        self.localModel.setHorizontalHeaderLabels(
-            ['Filename', 'Filesize', 'Filetype', 'Last modified'])
+        self.localModel = FileTableModel(self.icons, ['Filename', 'Filesize', 'Filetype', 'Last modified'], self)
         ui.localView.setModel(self.localModel)
+        ui.localView.sortByColumn(2, Qt.AscendingOrder)
         ui.localView.setSelectionBehavior(QTreeView.SelectRows)
-        ui.localView.setSelectionMode(QTreeView.SingleSelection)
+        ui.localView.setSelectionMode(QTreeView.ExtendedSelection)
         ui.localView.doubleClicked.connect(self.localviewClicked)
         ui.localView.setContextMenuPolicy(Qt.CustomContextMenu)
         ui.localView.customContextMenuRequested.connect(self.localMenu)
 
         # init remoteView
-        self.remoteModel = QStandardItemModel(0, 6)
-        self.remoteModel.setHorizontalHeaderLabels(
-            ['Filename', 'Filesize', 'Filetype', 'Last modified', 'Permissions', 'Owner/Group'])
+        self.remoteModel = FileTableModel(
+            self.icons, ['Filename', 'Filesize', 'Filetype', 'Last modified', 'Permissions', 'Owner/Group'], self)
         ui.remoteView.setModel(self.remoteModel)
+        ui.remoteView.sortByColumn(2, Qt.AscendingOrder)
         ui.remoteView.setSelectionBehavior(QTreeView.SelectRows)
-        ui.remoteView.setSelectionMode(QTreeView.SingleSelection)
+        ui.remoteView.setSelectionMode(QTreeView.ExtendedSelection)
         ui.remoteView.doubleClicked.connect(self.remoteviewClicked)
         ui.remoteView.setContextMenuPolicy(Qt.CustomContextMenu)
         ui.remoteView.customContextMenuRequested.connect(self.remoteMenu)
@@ -72,6 +240,11 @@ class MainWindow(QMainWindow):
         ui.connectButton.clicked.connect(self.connect_to_server)
         ui.disconnectButton.clicked.connect(self.disconnect_from_server)
 
+        self.settingsButton = QPushButton('Settings', ui.centralwidget)
+        self.settingsButton.setGeometry(QRect(774, 20, 81, 23))
+        self.settingsButton.clicked.connect(self.editSettings)
+        self.loadSettings()
+
         # init localupButton
         ui.localupButton.clicked.connect(self.localupClicked)
 
@@ -102,8 +275,8 @@ class MainWindow(QMainWindow):
         index = self.ui.localView.indexAt(pos)
         row = index.row()
         if row >= 0:
-            filename = self.localModel.item(row, 0).text()
-            filetype = self.localModel.item(row, 2).text()
+            filename = self.localModel.name(row)
+            is_dir = self.localModel.is_dir(row)
             def rename():
                 newname, ok = QInputDialog.getText(self, "Rename", "Enter new filename:", text=filename)
                 if ok:
@@ -112,17 +285,18 @@ class MainWindow(QMainWindow):
                     except Exception as e:
                         self.errorSlot(0, str(e))
                     finally:
-                        self.updateLocalList()
+                        self.localChanged()
             menu.addAction('Rename', rename)
             
-            if filetype == 'File Folder':
+            if is_dir:
+                menu.addAction('Upload directory', lambda: self.put_tree(filename))
                 def rmDir():
                     try:
                         os.rmdir(os.path.join(self.local_dir, filename))
                     except Exception as e:
                         self.errorSlot(0, str(e))
                     finally:
-                        self.updateLocalList()
+                        self.localChanged()
                 menu.addAction('Remove directory', rmDir)
             else:
                 def delFile():
@@ -131,7 +305,7 @@ class MainWindow(QMainWindow):
                     except Exception as e:
                         self.errorSlot(0, str(e))
                     finally:
-                        self.updateLocalList()
+                        self.localChanged()
                 menu.addAction('Remove file', delFile)
             menu.addSeparator()
 
@@ -143,7 +317,7 @@ class MainWindow(QMainWindow):
                 except Exception as e:
                     self.errorSlot(0, str(e))
                 finally:
-                    self.updateLocalList()
+                    self.localChanged()
         menu.addAction('Create directory', mkDir)
         menu.exec(QCursor.pos())
 
@@ -151,16 +325,30 @@ class MainWindow(QMainWindow):
         menu = QMenu()
         index = self.ui.remoteView.indexAt(pos)
         row = index.row()
-        if row >= 0:
-            filename = self.remoteModel.item(row, 0).text()
-            filetype = self.remoteModel.item(row, 2).text()
+        selected = [i.row() for i in self.ui.remoteView.selectionModel().selectedRows()]
+        if row in selected and len(selected) > 1:
+            def remove():
+                files, dirs = [], []
+                for r in selected:
+                    path = '{0}/{1}'.format(self.remote_dir, self.remoteModel.name(r))
+                    if self.remoteModel.is_dir(r):
+                        dirs.append(path)
+                    else:
+                        files.append(path)
+                self.removePaths.emit(files, dirs)
+            menu.addAction('Remove {0} selected items'.format(len(selected)), remove)
+            menu.addSeparator()
+        elif row >= 0:
+            filename = self.remoteModel.name(row)
+            is_dir = self.remoteModel.is_dir(row)
             def rename():
                 newname, ok = QInputDialog.getText(self, "Rename", "Enter new filename:", text=filename)
                 if ok:
                     self.rename.emit('{0}/{1}'.format(self.remote_dir, filename), '{0}/{1}'.format(self.remote_dir, newname))
             menu.addAction('Rename', rename)
 
-            if filetype == 'File Folder':
+            if is_dir:
+                menu.addAction('Download directory', lambda: self.get_tree(filename))
                 def rmDir():
                     self.rmDir.emit(
                         '{0}/{1}'.format(self.remote_dir, filename))
@@ -177,50 +365,87 @@ class MainWindow(QMainWindow):
             if ok:
                 self.mkDir.emit('{0}/{1}'.format(self.remote_dir, filename))
         menu.addAction('Create directory', mkDir)
+        menu.addAction('Refresh', self.refreshRemote.emit)
+        if self.transferQueue:
+            sync_menu = menu.addMenu('Synchronize')
+            for label, direction in (('Download changes', 'get'), ('Upload changes', 'put'), ('Both ways', 'both')):
+                sync_menu.addAction(label, lambda direction=direction: self.sync(direction))
+            sync_menu.addSeparator()
+            for label, direction in (('Preview download', 'get'), ('Preview upload', 'put'), ('Preview both ways', 'both')):
+                sync_menu.addAction(label, lambda direction=direction: self.sync(direction, True))
         menu.exec(QCursor.pos())
 
     @exception_catcher
     def localviewClicked(self, index):
         row = index.row()
-        filename = self.localModel.item(row, 0).text()
-        filetype = self.localModel.item(row, 2).text()
-        filesize = int(self.localModel.item(row, 1).text())
-        if filetype == 'File Folder':
+        filename = self.localModel.name(row)
+        filesize = self.localModel.size(row)
+        if self.localModel.is_dir(row):
             self.setLocaldir(os.path.join(self.local_dir, filename))
         else:
             self.put_file(filename, filesize)
 
     def remoteviewClicked(self, index):
         row = index.row()
-        filename = self.remoteModel.item(row, 0).text()
-        filetype = self.remoteModel.item(row, 2).text()
-        filesize = int(self.remoteModel.item(row, 1).text())
-        if filetype == 'File Folder':
+        filename = self.remoteModel.name(row)
+        filesize = self.remoteModel.size(row)
+        if self.remoteModel.is_dir(row):
             self.remotedirChanged.emit(filename)
         else:
             self.get_file(filename, filesize)
 
     def putClicked(self, _):
-        index = self.ui.localView.selectedIndexes()
-        if index:
-            filename = index[0].data()
-            filetype = index[2].data()
-            filesize = int(index[1].data())
-            if filetype == 'File Folder':
-                pass
+        files, dirs = [], []
+        for index in self.ui.localView.selectionModel().selectedRows():
+            row = index.row()
+            if not self.localModel.is_dir(row):
+                files.append((self.localModel.name(row), self.localModel.size(row)))
             else:
-                self.put_file(filename, filesize)
+                dirs.append(self.localModel.name(row))
+        for dirname in dirs:
+            self.put_tree(dirname)
+        if len(files) == 1 and not dirs:
+            self.put_file(*files[0])
+        elif files and self.transferQueue:
+            for filename, filesize in files:
+                self.transferQueue.add('put', os.path.join(self.local_dir, filename),
+                                       '{0}/{1}'.format(self.remote_dir, filename), filesize)
 
     def getClicked(self, _):
-        index = self.ui.remoteView.selectedIndexes()
-        if index:
-            filename = index[0].data()
-            filetype = index[2].data()
-            filesize = int(index[1].data())
-            if filetype == 'File Folder':
-                pass
+        files, dirs = [], []
+        for index in self.ui.remoteView.selectionModel().selectedRows():
+            row = index.row()
+            if not self.remoteModel.is_dir(row):
+                files.append((self.remoteModel.name(row), self.remoteModel.size(row)))
             else:
-                self.get_file(filename, filesize)
+                dirs.append(self.remoteModel.name(row))
+        for dirname in dirs:
+            self.get_tree(dirname)
+        if len(files) == 1 and not dirs:
+            self.get_file(*files[0])
+        elif files and self.transferQueue:
+            for filename, filesize in files:
+                self.transferQueue.add('get', os.path.join(self.local_dir, filename),
+                                       '{0}/{1}'.format(self.remote_dir, filename), filesize)
+
+    def put_tree(self, dirname):
+        if self.transferQueue:
+            self.transferQueue.put_tree(os.path.join(self.local_dir, dirname),
+                                        '{0}/{1}'.format(self.remote_dir.rstrip('/'), dirname))
+
+    def sync(self, direction, dry_run=False):
+        if self.transferQueue:
+            self.transferQueue.sync(self.local_dir, self.remote_dir, direction, dry_run)
+
+    def get_tree(self, dirname):
+        if self.transferQueue:
+            self.transferQueue.get_tree(os.path.join(self.local_dir, dirname),
+                                        '{0}/{1}'.format(self.remote_dir.rstrip('/'), dirname))
+
+    def queueFinished(self):
+        self.localChanged()
+        if self.remote_dir:
+            self.refreshRemote.emit()
 
     @exception_catcher
     def localupClicked(self, _):
@@ -250,45 +475,66 @@ class MainWindow(QMainWindow):
     def get_file(self, filename, filesize):
         local_path = os.path.join(self.local_dir, filename)
         remote_path = '{0}/{1}'.format(self.remote_dir, filename)
-        items = self.localModel.findItems(filename)
+        row = self.localModel.find(filename)
 
+        self.transfer_name = filename
         self.ui.statusbar.showMessage('Downloading file: {0} (Size: {1} bytes)'.format(filename, filesize))
         
-        if items and QMessageBox.question(self, "Local file exists", "Would you like to resume file transfer?", QMessageBox.Yes | QMessageBox.No):
-            item = items[0]
-            row = item.row()
-            offset = int(self.localModel.item(row, 1).text())
+        if row >= 0 and QMessageBox.question(self, "Local file exists", "Would you like to resume file transfer?", QMessageBox.Yes | QMessageBox.No) == QMessageBox.Yes:
+            offset = self.localModel.size(row)
             self.restFile.emit(local_path, remote_path, filesize, offset)
+        elif self.segments > 1 and filesize >= 2 * self.segment_size:
+            segments = min(self.segments, filesize // self.segment_size)
+            self.segFile.emit(local_path, remote_path, filesize, segments)
         else:
             self.getFile.emit(local_path, remote_path, filesize)
 
     def put_file(self, filename, filesize):
         local_path = os.path.join(self.local_dir, filename)
         remote_path = '{0}/{1}'.format(self.remote_dir, filename)
-        items = self.remoteModel.findItems(filename)
+        row = self.remoteModel.find(filename)
 
+        self.transfer_name = filename
         self.ui.statusbar.showMessage('Uploading file: {0} (Size: {1} bytes)'.format(filename, filesize))
 
-        if items and QMessageBox.question(self, "Remote file exists", "Would you like to resume file transfer?", QMessageBox.Yes | QMessageBox.No):
-            item = items[0]
-            row = item.row()
-            offset = int(self.remoteModel.item(row, 1).text())
+        if row >= 0 and QMessageBox.question(self, "Remote file exists", "Would you like to resume file transfer?", QMessageBox.Yes | QMessageBox.No) == QMessageBox.Yes:
+            offset = self.remoteModel.size(row)
             self.appeFile.emit(local_path, remote_path, filesize, offset)
         else:
             self.putFile.emit(local_path, remote_path, filesize)
 
+    def loadSettings(self):
+        settings = QSettings('FTP-Client', 'FTP-Client')
+        for name, kind in SETTINGS:
+            default = getattr(MainWindow, name)
+            value = settings.value(name, '' if default is None else default, type=kind)
+            setattr(self, name, None if value == '' else value)
+
+    def editSettings(self):
+        self.loadSettings()
+        dialog = SettingsDialog(self)
+        dialog.setValues({name: getattr(self, name) for name, _ in SETTINGS})
+        if dialog.exec_() == QDialog.Accepted:
+            settings = QSettings('FTP-Client', 'FTP-Client')
+            for name, value in dialog.values().items():
+                settings.setValue(name, '' if value is None else value)
+            self.loadSettings()
+
     def resetRemote(self):
         self.remote_dir = None
         self.ui.remotedirEdit.setText('')
-        self.remoteModel.removeRows(0, self.remoteModel.rowCount())
+        self.remoteModel.clear()
 
     def disconnect_from_server(self):
         if self.clientThread:
             self.ui.statusbar.showMessage('Disconnecting...')
-            self.clientThread.client.stop = True
+            self.clientThread.client.session.stop = True
             self.clientThread.quit()
+            self.transferQueue.stop()
+            self.transferQueue = None
+            close_pools()
             self.resetRemote()
-            self.transferUpdate(1)
+            self.transferUpdate({'finished': True})
             self.clientThread = None
 
     def connect_to_server(self):
@@ -298,81 +544,116 @@ class MainWindow(QMainWindow):
             else:
                 return
 
-        self.clientThread = CtrlThread(parent=self, trans_method=self.trans_method.checkedId(), server_info={
+        self.loadSettings()
+        server_info = {
             'hostname': self.ui.hostnameEdit.text(),
             'port': self.ui.portBox.value(),
             'username': self.ui.usernameEdit.text(),
-            'password': self.ui.passwordEdit.text()
-        })
+            'password': self.ui.passwordEdit.text(),
+            'buffer_size': self.buffer_size,
+            'auto_tune': self.auto_tune,
+            'list_ttl': self.list_ttl,
+            'checksum': self.checksum,
+            'verify': self.verify,
+            'compress': self.compress,
+            'compress_level': self.compress_level
+        }
+        self.clientThread = CtrlThread(parent=self, trans_method=self.trans_method.checkedId(), server_info=server_info,
+                                       backend=self.backend)
         self.clientThread.start()
+
+        self.transferQueue = TransferQueue(self, self.trans_method.checkedId(), server_info, self.transfer_workers)
+        self.transferQueue.jobAdded.connect(self.transferWindow.addJob)
+        self.transferQueue.jobUpdated.connect(self.transferWindow.updateJob)
+        self.transferQueue.queueFinished.connect(self.queueFinished)
+        self.transferQueue.error.connect(self.errorSlot)
+        self.transferQueue.syncPlanned.connect(self.syncWindow.showPlan)
+        self.transferWindow.clear()
         self.ui.statusbar.showMessage('Connecting...')
 
     def setRemotedir(self, remote_dir):
         self.remote_dir = remote_dir
         ui.remotedirEdit.setText(remote_dir)
 
-    def getExteninfo(self, extension):
-        provider = QFileIconProvider()
-        strTemplateName = QDir.tempPath() + QDir.separator() + QCoreApplication.applicationName() + "_XXXXXX." + extension
-        tmpFile = QTemporaryFile(strTemplateName)
-        tmpFile.setAutoRemove(False)
-        tmpFile.open()
-        tmpFile.close()
-        icon = provider.icon(QFileInfo(tmpFile.fileName()))
-        str_type = provider.type(QFileInfo(tmpFile.fileName()))
-        return icon, str_type
-
-    def updateRemotelist(self, detail):
-        rows = []
-        detail.sort(reverse=True)
-        for line in detail:
-            line = line.split(maxsplit=8)
-            if len(line) != 9:
-                self.errorSlot(0, 'LIST data read failed')
-                return
-            if line[0][0] == 'd':
-                provider = QFileIconProvider()
-                icon = provider.icon(QFileInfo('.'))
-                str_type = provider.type(QFileInfo('.'))
-            else:
-                icon, str_type = self.getExteninfo(os.path.basename(line[8]))
-            rows.append([(icon, line[8])] + [line[4], str_type, '{0} {1} {2}'.format(line[5], line[6], line[7]), line[0][1:], '{0}/{1}'.format(line[2], line[3])])
-        self.remoteModel.removeRows(0, self.remoteModel.rowCount())
-        for row in rows:
-            self.remoteModel.appendRow([QStandardItem(*row[0])] + [QStandardItem(item) for item in row[1:]])
+    def updateRemotelist(self, entries):
+        self.remoteModel.setEntries(entries)
 
-        self.ui.remoteView.sortByColumn(2, Qt.SortOrder.AscendingOrder)
+    def appendRemotelist(self, entries):
+        self.remoteModel.appendEntries(entries)
+
+    def patchRemotelist(self, delta):
+        self.remoteModel.patch(delta)
 
     @exception_catcher
     def setLocaldir(self, dir):
         self.local_dir = dir
         self.ui.localdirEdit.setText(dir)
+        if self.localWatcher.directories():
+            self.localWatcher.removePaths(self.localWatcher.directories())
+        self.localWatcher.addPath(dir)
         self.updateLocalList()
 
-    def getFileinfo(self, path):
-        provider = QFileIconProvider()
-        icon = provider.icon(QFileInfo(path))
-        str_type = provider.type(QFileInfo(path))
-        return icon, str_type
+    def localChanged(self, *_):
+        self.localTimer.start()
+
+    def diffLocalList(self):
+        if self.localScanner:
+            self.localTimer.start()
+            return
+        self.localScanner = LocalScanner(self, self.local_dir, self.local_scan, self.localModel.snapshot())
+        self.localScanner.deltaFound.connect(self.localDeltaFound)
+        self.localScanner.scanFinished.connect(self.localScanFinished)
+        self.localScanner.start()
+
+    def localDeltaFound(self, generation, delta):
+        if generation != self.local_scan:
+            return
+        self.localModel.patch(delta)
+        self.local_batches += 1
 
-    @exception_catcher
     def updateLocalList(self):
-        self.localModel.removeRows(0, self.localModel.rowCount())
-        files = os.listdir(self.local_dir)
-        files.sort(key=lambda x: not os.path.isdir(os.path.join(self.local_dir, x)))
-        for filename in files:
-            path = os.path.join(self.local_dir, filename)
-            icon, str_type = self.getFileinfo(path)
-            row = [QStandardItem(icon, filename)] + [QStandardItem(i) for i in [str(os.path.getsize(path)), str_type, time.strftime('%Y-%m-%d %H:%M', time.gmtime(os.path.getmtime(path)))]]
-            self.localModel.appendRow(row)
-
-    def transferUpdate(self, progress):
-        if progress == 1:
+        if self.localScanner:
+            self.localScanner.cancel()
+        self.local_scan += 1
+        self.local_batches = 0
+        self.localScanner = LocalScanner(self, self.local_dir, self.local_scan)
+        self.localScanner.entriesFound.connect(self.localEntriesFound)
+        self.localScanner.scanFinished.connect(self.localScanFinished)
+        self.localScanner.start()
+
+    def localEntriesFound(self, generation, entries):
+        if generation != self.local_scan:
+            return
+        if self.local_batches:
+            self.localModel.appendEntries(entries)
+        else:
+            self.localModel.setEntries(entries)
+        self.local_batches += 1
+
+    def localScanFinished(self, generation, error):
+        if generation != self.local_scan:
+            return
+        self.localScanner = None
+        if error:
+            self.errorSlot(0, error)
+        elif not self.local_batches:
+            self.localModel.setEntries([])
+
+    def transferUpdate(self, stats):
+        if stats['finished']:
             self.progressBar.setValue(100)
             self.progressBar.hide()
+            return
+        done, size = stats['done'], stats['size']
+        self.progressBar.setValue(done * 100 // size if size else 100)
+        self.progressBar.show()
+        if stats['eta'] < 0:
+            eta = '--:--:--'
         else:
-            self.progressBar.setValue(progress * 100)
-            self.progressBar.show()
+            eta = time.strftime('%H:%M:%S', time.gmtime(stats['eta']))
+        self.ui.statusbar.showMessage('{0}: {1} / {2}, {3}/s (avg {4}/s), ETA {5}'.format(
+            self.transfer_name, format_size(done), format_size(size),
+            format_size(stats['speed']), format_size(stats['avg_speed']), eta))
 
     def errorSlot(self, code, detail):
         if code in [-1, 421]:
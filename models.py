@@ -0,0 +1,217 @@
+import os
+import sys
+import time
+from array import array
+from collections import OrderedDict
+from PyQt5.QtCore import Qt, QAbstractTableModel, QModelIndex, QFileInfo, QTemporaryDir, QTimer
+from PyQt5.QtWidgets import QFileIconProvider
+
+# delay before re-sorting after rows were appended, so a streamed listing sorts once
+RESORT_DELAY = 200
+
+
+class IconCache(object):
+    # icon and type string per file extension, resolved from one probe file
+    # per distinct extension; '/' is the key for directories
+    def __init__(self, maxsize=512):
+        self.maxsize = maxsize
+        self.provider = QFileIconProvider()
+        self.probes = QTemporaryDir()
+        self.entries = OrderedDict()
+
+    def key(self, name, is_dir):
+        return '/' if is_dir else os.path.splitext(name)[1].lower()
+
+    def probe(self, key):
+        if key == '/':
+            return QFileInfo(self.probes.path())
+        path = os.path.join(self.probes.path(), 'probe' + key)
+        if not os.path.exists(path):
+            open(path, 'wb').close()
+        return QFileInfo(path)
+
+    def lookup(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            item = self.entries[key] = [self.provider.type(self.probe(key)), None]
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+        else:
+            self.entries.move_to_end(key)
+        return item
+
+    def type(self, name, is_dir=False):
+        return self.lookup(self.key(name, is_dir))[0]
+
+    def icon(self, name, is_dir=False):
+        key = self.key(name, is_dir)
+        item = self.lookup(key)
+        if item[1] is None:
+            item[1] = self.provider.icon(self.probe(key))
+        return item[1]
+
+
+class FileTableModel(QAbstractTableModel):
+    # entries are kept column-wise, one list or array per field; cells are
+    # formatted on demand in data()
+    def __init__(self, icons, headers, parent=None):
+        super(FileTableModel, self).__init__(parent)
+        self.icons = icons
+        self.headers = headers
+        self.sort_column = 2
+        self.sort_order = Qt.AscendingOrder
+        self.resort_timer = QTimer(self)
+        self.resort_timer.setSingleShot(True)
+        self.resort_timer.setInterval(RESORT_DELAY)
+        self.resort_timer.timeout.connect(self.resort)
+        self.clear_store()
+
+    def clear_store(self):
+        self.names = []
+        self.dirs = bytearray()
+        self.sizes = array('q')
+        self.modifies = array('d')
+        self.perms = []
+        self.owners = []
+
+    def append_store(self, entries):
+        for entry in entries:
+            self.names.append(entry.name)
+            self.dirs.append(entry.type == 'dir')
+            self.sizes.append(entry.size or 0)
+            self.modifies.append(-1 if entry.modify is None else entry.modify)
+            self.perms.append(sys.intern(entry.perm or ''))
+            self.owners.append(sys.intern(entry.owner or ''))
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.names)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+        return None
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, column = index.row(), index.column()
+        if role == Qt.DisplayRole:
+            return self.text(row, column)
+        if role == Qt.DecorationRole and column == 0:
+            return self.icons.icon(self.names[row], self.dirs[row])
+        return None
+
+    def text(self, row, column):
+        if column == 0:
+            return self.names[row]
+        if column == 1:
+            return str(self.sizes[row])
+        if column == 2:
+            return self.icons.type(self.names[row], self.dirs[row])
+        if column == 3:
+            modify = self.modifies[row]
+            return '' if modify < 0 else time.strftime('%Y-%m-%d %H:%M', time.gmtime(modify))
+        if column == 4:
+            return self.perms[row]
+        return self.owners[row]
+
+    def name(self, row):
+        return self.names[row]
+
+    def is_dir(self, row):
+        return bool(self.dirs[row])
+
+    def size(self, row):
+        return self.sizes[row]
+
+    def find(self, name):
+        try:
+            return self.names.index(name)
+        except ValueError:
+            return -1
+
+    def setEntries(self, entries):
+        self.resort_timer.stop()
+        self.beginResetModel()
+        self.clear_store()
+        self.append_store(entries)
+        self.permute(self.sorted_rows())
+        self.endResetModel()
+
+    def appendEntries(self, entries):
+        if not entries:
+            return
+        first = len(self.names)
+        self.beginInsertRows(QModelIndex(), first, first + len(entries) - 1)
+        self.append_store(entries)
+        self.endInsertRows()
+        self.resort_timer.start()
+
+    def set_row(self, row, entry):
+        self.names[row] = entry.name
+        self.dirs[row] = entry.type == 'dir'
+        self.sizes[row] = entry.size or 0
+        self.modifies[row] = -1 if entry.modify is None else entry.modify
+        self.perms[row] = sys.intern(entry.perm or '')
+        self.owners[row] = sys.intern(entry.owner or '')
+
+    def patch(self, delta):
+        # delta holds (name, entry) pairs, entry None for a removed name
+        changes = dict(delta)
+        removed = []
+        for row in [row for row, name in enumerate(self.names) if name in changes]:
+            entry = changes.pop(self.names[row])
+            if entry:
+                self.set_row(row, entry._replace(name=self.names[row]))
+                self.dataChanged.emit(self.index(row, 0), self.index(row, len(self.headers) - 1))
+                self.resort_timer.start()
+            else:
+                removed.append(row)
+        for row in reversed(removed):
+            self.beginRemoveRows(QModelIndex(), row, row)
+            for column in (self.names, self.dirs, self.sizes, self.modifies, self.perms, self.owners):
+                del column[row]
+            self.endRemoveRows()
+        self.appendEntries([entry for entry in changes.values() if entry])
+
+    def snapshot(self):
+        return dict(zip(self.names, zip(self.dirs, self.sizes, self.modifies)))
+
+    def clear(self):
+        self.setEntries([])
+
+    def sorted_rows(self):
+        if self.sort_column == 2:
+            key = lambda row: (self.text(row, 2), self.names[row])
+        else:
+            values = (self.names, self.sizes, None, self.modifies, self.perms, self.owners)[self.sort_column]
+            key = values.__getitem__
+        return sorted(range(len(self.names)), key=key, reverse=self.sort_order == Qt.DescendingOrder)
+
+    def permute(self, rows):
+        self.names = [self.names[row] for row in rows]
+        self.dirs = bytearray(self.dirs[row] for row in rows)
+        self.sizes = array('q', (self.sizes[row] for row in rows))
+        self.modifies = array('d', (self.modifies[row] for row in rows))
+        self.perms = [self.perms[row] for row in rows]
+        self.owners = [self.owners[row] for row in rows]
+
+    def sort(self, column, order=Qt.AscendingOrder):
+        self.sort_column = column
+        self.sort_order = order
+        self.resort()
+
+    def resort(self):
+        self.resort_timer.stop()
+        self.layoutAboutToBeChanged.emit()
+        rows = self.sorted_rows()
+        self.permute(rows)
+        persistent = self.persistentIndexList()
+        if persistent:
+            moved = dict((old, new) for new, old in enumerate(rows))
+            self.changePersistentIndexList(persistent, [self.index(moved[index.row()], index.column())
+                                                        for index in persistent])
+        self.layoutChanged.emit()
@@ -0,0 +1,990 @@
+import os
+import re
+import socket
+import time
+import zlib
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from core import FTPError, BufferPolicy, TransferProgress, connection_lost, parse_reply, reply_end
+from core import parse_features, parse_mlst, mlst_facts, deflate_commands, deflate_accepted, DEFAULT_DEFLATE_LEVEL
+from core import ListingCache, ListingReader, DEFAULT_LIST_TTL
+from core import hash_method, hash_commands, hash_result, new_hash, hash_file, file_digest, parse_digest, same_digest
+from core import transfer_hash, digest_detail, sidecar_path, local_sidecar, resume_plan, reply_size, PREFIX_DIFFERS
+from core import walk_local, sync_plan, missing_parents, parse_mdtm
+
+# attempts a download segment gets after its first failure
+SEGMENT_RETRIES = 3
+# seconds a control connection may sit idle before it is sent a NOOP
+KEEPALIVE_INTERVAL = 30
+# commands a pipelined batch keeps in flight before waiting for replies
+PIPELINE_DEPTH = 64
+
+# MDTM commands pipelined per batch when a listing carries no times
+SYNC_MDTM_BATCH = 256
+
+
+class FTPSession(object):
+    # blocking FTP session without Qt: results are returned, failures raised
+    # as FTPError or socket.error, and messages, replies and progress go to
+    # the optional on_info, on_debug and on_progress callables
+    stop = False
+    remote_dir = '/'
+    server_info = {}
+    trans_method = 0
+
+    features = {}
+    reply_lines = []
+    list_cache = None
+
+    ctrl_socket = None
+    ctrl_buffer = None
+    data_thread = None
+    last_used = 0
+    recv_buffer = None
+    buffer_policy = None
+    # (algorithm, hex digest) of the last complete transfer, when hashing
+    last_digest = None
+    # data connections are deflated (MODE Z)
+    compressing = False
+
+    init_datasock = None
+
+    on_info = None
+    on_debug = None
+    on_progress = None
+
+    def notify(self, text):
+        if self.on_info:
+            self.on_info(text)
+
+    def log(self, text):
+        if self.on_debug:
+            self.on_debug(text)
+
+    def report(self, stats):
+        if self.on_progress:
+            self.on_progress(stats)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def open_ctrl(self, server_info, trans_method):
+        self.server_info = server_info
+        self.trans_method = trans_method
+        self.buffer_policy = BufferPolicy.from_profile(server_info)
+        self.list_cache = ListingCache(server_info.get('list_ttl', DEFAULT_LIST_TTL))
+        if trans_method:
+            self.init_datasock = self.init_PORT
+        else:
+            self.init_datasock = self.init_PASV
+
+        self.ctrl_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.ctrl_socket.settimeout(10)
+        self.ctrl_buffer = bytearray()
+        if self.login() == 0:
+            start = time.monotonic()
+            _, detail = self.com_SYST()
+            self.buffer_policy.add_rtt(time.monotonic() - start)
+
+            _, detail = self.com_TYPE()
+
+            try:
+                _, _ = self.send_command('FEAT', [211])
+                self.features = parse_features(self.reply_lines)
+                if mlst_facts(self.features):
+                    _, _ = self.send_command('OPTS MLST {0}'.format(mlst_facts(self.features)), [200])
+            except FTPError:
+                self.features = {}
+            self.negotiate_mode()
+
+    def negotiate_mode(self):
+        self.compressing = deflate_accepted(self.pipeline(deflate_commands(self.server_info, self.features)))
+
+    def restore(self):
+        self.close_ctrl()
+        self.open_ctrl(self.server_info, self.trans_method)
+        if self.remote_dir != '/':
+            _, _ = self.com_CWD(self.remote_dir)
+
+    def close_ctrl(self):
+        if self.ctrl_socket:
+            try:
+                self.ctrl_socket.sendall('QUIT\r\n'.encode('utf-8'))
+            except socket.error:
+                pass
+            self.ctrl_socket.close()
+
+    def ping(self):
+        # keeps an idle connection open, reconnecting when the server dropped it
+        if time.monotonic() - self.last_used < KEEPALIVE_INTERVAL:
+            return
+        try:
+            _, _ = self.com_NOOP()
+        except (socket.error, FTPError) as e:
+            # NOOP touches nothing but the control connection, so any socket
+            # error here means it is gone
+            if isinstance(e, FTPError) and not connection_lost(e):
+                raise
+            self.restore()
+            self.notify('Connection lost, reconnected to {0}'.format(self.server_info['hostname']))
+
+    def close(self):
+        self.close_ctrl()
+        self.ctrl_socket = None
+
+    def login(self):
+        self.ctrl_socket.connect(
+            (self.server_info['hostname'], self.server_info['port']))
+
+        _, _ = self.read_reply([220])
+
+        code, _ = self.send_command('USER {0}'.format(self.server_info['username']), [230, 331])
+
+        if code == 331:
+            _, _ = self.send_command('PASS {0}'.format(self.server_info['password']), [230])
+
+        return 0
+
+    def com_LIST(self, path=None):
+        return self.send_command('LIST {0}'.format(path) if path else 'LIST', [125, 150])
+
+    def com_MLSD(self, path=None):
+        return self.send_command('MLSD {0}'.format(path) if path else 'MLSD', [125, 150])
+
+    def com_REST(self, offset):
+        return self.send_command('REST {0}'.format(offset), [350])
+
+    def com_APPE(self, filename):
+        return self.send_command('APPE {0}'.format(filename), [125, 150])
+
+    def com_RETR(self, filename):
+        return self.send_command('RETR {0}'.format(filename), [125, 150])
+
+    def com_STOR(self, filename):
+        return self.send_command('STOR {0}'.format(filename), [125, 150])
+
+    def com_SIZE(self, path):
+        return self.send_command('SIZE {0}'.format(path), [213])
+
+    def com_MDTM(self, path):
+        return self.send_command('MDTM {0}'.format(path), [213])
+
+    def com_NOOP(self):
+        return self.send_command('NOOP', [200])
+
+    def com_SYST(self):
+        return self.send_command('SYST', [215])
+
+    def com_TYPE(self):
+        return self.send_command('TYPE I', [200])
+
+    def com_DELE(self, path):
+        return self.send_command('DELE {0}'.format(path), [250])
+
+    def com_CWD(self, path):
+        return self.send_command('CWD {0}'.format(path), [250])
+
+    def com_PWD(self):
+        return self.send_command('PWD', [257])
+
+    def com_MKD(self, path):
+        return self.send_command('MKD {0}'.format(path), [257])
+
+    def com_RMD(self, path):
+        return self.send_command('RMD {0}'.format(path), [250])
+
+    def com_RNFR(self, path):
+        return self.send_command('RNFR {0}'.format(path), [350])
+
+    def com_RNTO(self, path):
+        return self.send_command('RNTO {0}'.format(path), [250])
+
+    def pwd(self):
+        _, detail = self.com_PWD()
+        self.remote_dir = re.match(r'"(.*)"', detail).group(1)
+        return self.remote_dir
+
+    def cwd(self, path):
+        _, _ = self.com_CWD(path)
+        return self.pwd()
+
+    def init_PORT(self, command, *args):
+        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listen_socket.bind(('', 0))
+        listen_socket.listen(1)
+        addr, _ = self.ctrl_socket.getsockname()
+        _, port = listen_socket.getsockname()
+        h = [int(i) for i in addr.split('.')]
+        p1 = port // 256
+        p2 = port % 256
+        _, _ = self.send_command('PORT {0},{1},{2},{3},{4},{5}'.format(h[0], h[1], h[2], h[3], p1, p2), [200])
+        command(*args)
+        data_socket, _ = listen_socket.accept()
+        listen_socket.close()
+        return data_socket
+
+    def init_PASV(self, command, *args):
+        _, addr_str = self.send_command('PASV', [227])
+        res = re.search(r'(\d*),(\d*),(\d*),(\d*),(\d*),(\d*)', addr_str)
+        addr = [int(res.group(i)) for i in range(1, 7)]
+        data_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        data_socket.connect(('{0}.{1}.{2}.{3}'.format(addr[0], addr[1], addr[2], addr[3]), addr[4]*256+addr[5]))
+        command(*args)
+        return data_socket
+
+    def list_dir(self, path=None, deliver=None):
+        mlsd = 'MLST' in self.features
+        data_socket = self.init_datasock(self.com_MLSD if mlsd else self.com_LIST, path)
+        reader = ListingReader(mlsd, deliver)
+        inflate = zlib.decompressobj() if self.compressing else None
+        try:
+            while True:
+                recv_data = data_socket.recv(self.buffer_policy.size)
+                if not recv_data:
+                    break
+                reader.feed(inflate.decompress(recv_data) if inflate else recv_data)
+            if inflate:
+                reader.feed(inflate.flush())
+        finally:
+            data_socket.close()
+        entries = reader.close()
+        _, _ = self.read_reply([226])
+        return entries
+
+    def cached_list(self, path, refresh=False, deliver=None):
+        entries = None if refresh else self.list_cache.get(path)
+        if entries is None:
+            entries = self.list_dir(path, deliver)
+            self.list_cache.put(path, entries)
+        elif deliver:
+            deliver(list(entries))
+        return list(entries)
+
+    def remote_entry(self, path, fallback):
+        # fresh facts via MLST where supported, otherwise what the caller already knows
+        try:
+            entry = self.stat_entry(path)
+        except FTPError as e:
+            if connection_lost(e):
+                raise
+            entry = None
+        return entry or fallback
+
+    def stat_entry(self, path):
+        if 'MLST' not in self.features:
+            return None
+        _, _ = self.send_command('MLST {0}'.format(path), [250])
+        return parse_mlst(self.reply_lines)
+
+    def recv_file(self, data_socket, f, size, offset=0, digest=None):
+        # False when the transfer was stopped before the end
+        policy = self.buffer_policy
+        policy.start()
+        progress = TransferProgress(self.report, size, offset)
+        inflate = zlib.decompressobj() if self.compressing else None
+        complete = True
+        while True:
+            if self.stop:
+                self.stop = False
+                complete = False
+                break
+            if self.recv_buffer is None or len(self.recv_buffer) < policy.size:
+                self.recv_buffer = memoryview(bytearray(policy.size))
+            buf = self.recv_buffer
+            n = data_socket.recv_into(buf, policy.size)
+            if not n:
+                if inflate:
+                    self.write_data(f, inflate.flush(), digest, progress)
+                break
+            self.write_data(f, inflate.decompress(buf[:n]) if inflate else buf[:n], digest, progress)
+            policy.record(n)
+        progress.finish()
+        return complete
+
+    def write_data(self, f, data, digest, progress):
+        f.write(data)
+        if digest:
+            digest.update(data)
+        progress.update(len(data))
+
+    def start_digest(self, local_path, offset):
+        # a resumed transfer's digest covers the part already in place too
+        algo = transfer_hash(self.server_info, self.features)
+        if not algo:
+            return None, None
+        digest = new_hash(algo)
+        if offset:
+            hash_file(digest, local_path, offset)
+        return algo, digest
+
+    def retrieve(self, local_path, remote_path, size, offset=0):
+        algo, digest = self.start_digest(local_path, offset)
+        # the local file is opened before RETR, so a local error never leaves a
+        # transfer half started; existing data is only cut once RETR is accepted
+        created = not os.path.exists(local_path)
+        f = open(local_path, 'wb' if created else 'r+b')
+        with f:
+            try:
+                if offset:
+                    _, _ = self.com_REST(offset)
+                data_socket = self.init_datasock(self.com_RETR, remote_path)
+            except (socket.error, FTPError):
+                f.close()
+                if created:
+                    os.remove(local_path)
+                raise
+            try:
+                f.seek(offset)
+                f.truncate()
+                complete = self.recv_file(data_socket, f, size, offset, digest)
+            except OSError as e:
+                self.abort_data(data_socket, e)
+                raise
+            data_socket.close()
+        code, detail = self.read_reply([226])
+        if digest and complete:
+            detail = self.check_digest(detail, algo, digest.hexdigest(), local_path, remote_path, False)
+        return code, detail
+
+    def abort_data(self, data_socket, error):
+        # after a local failure mid-transfer the transfer's final reply is still
+        # read, so the control connection stays in step
+        data_socket.close()
+        if not connection_lost(error):
+            self.read_reply()
+
+    def remote_digest(self, path, length=None):
+        # (algorithm, digest) of path, or of its first length bytes, computed
+        # by the server; None when it cannot hash
+        method = hash_method(self.features)
+        if method is None:
+            return None
+        return hash_result(method, self.pipeline(hash_commands(method, path, length)))
+
+    def remote_sidecar(self, path, algo):
+        path = sidecar_path(path, algo)
+        if self.remote_size(path) is None:
+            return None
+        data_socket = self.init_datasock(self.com_RETR, path)
+        chunks = []
+        try:
+            while True:
+                data = data_socket.recv(4096)
+                if not data:
+                    break
+                chunks.append(data)
+        finally:
+            data_socket.close()
+        _, _ = self.read_reply([226])
+        data = b''.join(chunks)
+        if self.compressing:
+            data = zlib.decompress(data)
+        return parse_digest(data.decode('ascii', 'replace'))
+
+    def check_digest(self, detail, algo, value, local_path, remote_path, upload):
+        # compares the digest taken in flight with the server's or with the
+        # source's sidecar file, and appends it to the completion reply
+        self.last_digest = (algo, value)
+        verify = self.server_info.get('verify')
+        expected = None
+        if verify == 'server':
+            remote = self.remote_digest(remote_path)
+            if remote and remote[0] == algo:
+                expected = remote[1]
+        elif verify == 'sidecar':
+            expected = local_sidecar(local_path, algo) if upload else self.remote_sidecar(remote_path, algo)
+        if verify and not expected:
+            self.notify('{0} not verified, no {1} digest to compare with'.format(remote_path, algo))
+        return digest_detail(detail, algo, value, expected, verify, remote_path)
+
+    def remote_size(self, path):
+        return reply_size(self.pipeline([('SIZE {0}'.format(path), [213])])[0])
+
+    def prefix_matches(self, local_path, remote_path, length):
+        # compares a server-side hash of the first length bytes with the local
+        # file; None when the server cannot hash a range
+        remote = self.remote_digest(remote_path, length) if length else None
+        if remote is None:
+            return None
+        return same_digest(remote[1], file_digest(local_path, remote[0], length))
+
+    def resume_offset(self, local_path, remote_path, offset, upload):
+        # the exact offset to resume at, or 0 to restart the transfer
+        offset, reason = resume_plan(local_path, self.remote_size(remote_path), offset, upload)
+        if offset and self.prefix_matches(local_path, remote_path, offset) is False:
+            offset, reason = 0, PREFIX_DIFFERS
+        if reason:
+            self.notify(reason)
+        return offset
+
+    def read_range(self, local_path, remote_path, start, end, buf, received, stopped):
+        # writes start..end of the remote file into place, calling received(n)
+        # for every chunk; closing the data connection before the end of the
+        # file makes the server answer 426, which keeps the session in step
+        pos = start
+        _, _ = self.com_REST(pos)
+        data_socket = self.init_datasock(self.com_RETR, remote_path)
+        try:
+            with open(local_path, 'r+b') as f:
+                f.seek(pos)
+                while pos < end and not stopped():
+                    n = data_socket.recv_into(buf, min(len(buf), end - pos))
+                    if not n:
+                        break
+                    f.write(buf[:n])
+                    pos += n
+                    received(n)
+        except OSError as e:
+            self.abort_data(data_socket, e)
+            raise
+        data_socket.close()
+        _, _ = self.read_reply()
+        if pos < end and not stopped():
+            raise FTPError(0, 'data connection closed at byte {0}'.format(pos))
+
+    def fetch_ranges(self, pool, ranges, local_path, remote_path, progress):
+        # works off the shared ranges with this session (pool None) or with one
+        # pooled session; a range that fails goes back from the byte it reached.
+        # A pooled connection the server refuses just leaves its share to the others
+        buf = memoryview(bytearray(self.buffer_policy.size))
+        session = None if pool else self
+        stopped = lambda: self.stop
+        total = [0]
+        attempt = 0
+        while True:
+            # the connection comes first, so a worker waiting for one of the
+            # server's few never holds a range the others wait on
+            if session is None:
+                try:
+                    session = pool.acquire()
+                except (socket.error, FTPError) as e:
+                    self.log('no extra connection for segments ({0})'.format(e))
+                    return total[0]
+            item = ranges.take(stopped)
+            if item is None:
+                break
+            start, end = item
+            reached = [start]
+
+            def received(n):
+                reached[0] += n
+                with ranges.cond:
+                    total[0] += n
+                    progress.update(n)
+            try:
+                session.read_range(local_path, remote_path, start, end, buf, received, stopped)
+                ranges.done((reached[0], end) if reached[0] < end else None)
+            except (socket.error, FTPError) as e:
+                ranges.done((reached[0], end))
+                attempt += 1
+                if pool:
+                    pool.release(session, connection_lost(e))
+                    session = None
+                elif connection_lost(e):
+                    self.restore()
+                if attempt > SEGMENT_RETRIES:
+                    if pool:
+                        self.log('giving up a segment connection ({0})'.format(e))
+                        return total[0]
+                    raise FTPError(451, 'segment {0}-{1} failed: {2}'.format(start, end, e))
+                self.log('segment {0}-{1} failed at byte {2} ({3}), retrying'.format(start, end, reached[0], e))
+        if pool and session is not None:
+            pool.release(session)
+        return total[0]
+
+    def get_segments(self, local_path, remote_path, size, segments):
+        # downloads over several connections at once, this one and up to
+        # segments - 1 pooled ones; returns the completion reply, or None when
+        # stopped. The ranges need the exact size, without it there is one stream
+        remote_size = self.remote_size(remote_path)
+        if not remote_size:
+            if remote_size is None:
+                self.log('size of {0} unknown, downloading in one stream'.format(remote_path))
+            return self.retrieve(local_path, remote_path, size)
+        size = remote_size
+        with open(local_path, 'wb') as f:
+            f.truncate(size)
+        bounds = [size * i // segments for i in range(segments + 1)]
+        ranges = RangeQueue([(bounds[i], bounds[i + 1]) for i in range(segments) if bounds[i] < bounds[i + 1]])
+        progress = TransferProgress(self.report, size)
+        pool = get_pool(self.server_info, self.trans_method)
+        with ThreadPoolExecutor(segments) as executor:
+            futures = [executor.submit(self.fetch_ranges, pool if i else None, ranges,
+                                       local_path, remote_path, progress)
+                       for i in range(segments)]
+            received = sum(future.result() for future in futures)
+        progress.finish()
+        if self.stop:
+            self.stop = False
+            return None
+        if received != size:
+            raise FTPError(451, 'size mismatch: expected {0} bytes, got {1}'.format(size, received))
+        detail = 'Downloaded {0} bytes in {1} segments'.format(received, segments)
+        algo = transfer_hash(self.server_info, self.features)
+        if algo:
+            # the segments arrive out of order, so the digest is taken from the
+            # finished file
+            value = file_digest(local_path, algo, size, self.buffer_policy.size)
+            detail = self.check_digest(detail, algo, value, local_path, remote_path, False)
+        return 226, detail
+
+    def send_file(self, data_socket, f, size, offset=0, digest=None):
+        # sendfile keeps the data out of user space; hashing and deflating need it read
+        policy = self.buffer_policy
+        policy.start()
+        progress = TransferProgress(self.report, size, offset)
+        deflate = None
+        if self.compressing:
+            deflate = zlib.compressobj(self.server_info.get('compress_level', DEFAULT_DEFLATE_LEVEL))
+        complete = True
+        f.seek(offset)
+        while True:
+            if self.stop:
+                self.stop = False
+                complete = False
+                break
+            if digest or deflate:
+                data = f.read(policy.size)
+                if digest:
+                    digest.update(data)
+                if deflate:
+                    data_socket.sendall(deflate.compress(data) if data else deflate.flush())
+                elif data:
+                    data_socket.sendall(data)
+                sent = len(data)
+            else:
+                sent = data_socket.sendfile(f, progress.done, policy.size)
+            if not sent:
+                break
+            policy.record(sent)
+            progress.update(sent)
+        progress.finish()
+        return complete
+
+    def store(self, local_path, remote_path, size, offset=0):
+        algo, digest = self.start_digest(local_path, offset)
+        # opened before STOR/APPE, so a missing or unreadable file never
+        # creates a remote one
+        with open(local_path, 'rb') as f:
+            if offset:
+                data_socket = self.init_datasock(self.com_APPE, remote_path)
+            else:
+                data_socket = self.init_datasock(self.com_STOR, remote_path)
+            try:
+                complete = self.send_file(data_socket, f, size, offset, digest)
+            except OSError as e:
+                self.abort_data(data_socket, e)
+                raise
+            data_socket.close()
+        code, detail = self.read_reply([226])
+        if digest and complete:
+            detail = self.check_digest(detail, algo, digest.hexdigest(), local_path, remote_path, True)
+        return code, detail
+
+    def keep_time(self, direction, local_path, remote_path, modify):
+        # gives the copy the source's modification time; uploads need MFMT
+        if direction == 'get':
+            os.utime(local_path, (modify, modify))
+        elif 'MFMT' in self.features:
+            _, _ = self.send_command('MFMT {0} {1}'.format(
+                time.strftime('%Y%m%d%H%M%S', time.gmtime(modify)), remote_path), [213])
+
+    def list(self, path=None):
+        return self.list_dir(path)
+
+    def get(self, remote_path, local_path=None, resume=False, segments=1):
+        # downloads remote_path, by default to its name in the working
+        # directory, and returns the completion reply; resume continues a
+        # partial local file when its data matches the server's
+        local_path = local_path or posixpath.basename(remote_path)
+        size = self.remote_size(remote_path) or 0
+        offset = 0
+        if resume and os.path.exists(local_path):
+            offset = self.resume_offset(local_path, remote_path, os.path.getsize(local_path), False)
+        if segments > 1 and not offset and not self.compressing:
+            return self.get_segments(local_path, remote_path, size, segments)
+        return self.retrieve(local_path, remote_path, size, offset)
+
+    def put(self, local_path, remote_path=None, resume=False):
+        remote_path = remote_path or os.path.basename(local_path)
+        size = os.path.getsize(local_path)
+        offset = self.resume_offset(local_path, remote_path, 0, True) if resume else 0
+        return self.store(local_path, remote_path, size, offset)
+
+    def transfer(self, direction, local_path, remote_path, size, offset=0, modify=None):
+        # one download ('get') or upload ('put'), giving the copy the source's
+        # mtime when modify is known
+        if direction == 'get':
+            code, detail = self.retrieve(local_path, remote_path, size, offset)
+        else:
+            code, detail = self.store(local_path, remote_path, size, offset)
+        if modify is not None:
+            self.keep_time(direction, local_path, remote_path, modify)
+        return code, detail
+
+    def mirror(self, local_dir, remote_dir, direction='get', dry_run=False, workers=4):
+        # brings local_dir and remote_dir in line as sync_plan decides, over up
+        # to workers pooled sessions, and returns the plan
+        remote_dir = posixpath.join(self.remote_dir, remote_dir)
+        mirror = Mirror(get_pool(self.server_info, self.trans_method, workers),
+                        local_dir, remote_dir, direction, workers)
+        plan = mirror.plan()
+        for failure in mirror.failed:
+            self.notify('Could not list {0}'.format(failure))
+        if dry_run:
+            return plan
+        failed = mirror.run(mirror.prepare(plan), lambda action, detail: self.notify(
+            '{0} {1}: {2}'.format(action.direction, action.path, detail)))
+        if failed:
+            raise FTPError(451, '{0} of {1} transfers failed'.format(
+                len(failed), len([action for action in plan if action.direction != 'skip'])))
+        return plan
+
+    def read_line(self):
+        while True:
+            i = self.ctrl_buffer.find(b'\n')
+            if i >= 0:
+                line = bytes(self.ctrl_buffer[:i + 1])
+                del self.ctrl_buffer[:i + 1]
+                return line.decode('utf-8', 'replace').rstrip('\r\n')
+            recv_data = self.ctrl_socket.recv(8192)
+            if not recv_data:
+                raise FTPError(421, 'Connection closed by server')
+            self.ctrl_buffer += recv_data
+
+    def read_reply(self, expect_code=None):
+        line = self.read_line()
+        lines = [line]
+        end = reply_end(line)
+        while end and not (line + ' ').startswith(end):
+            line = self.read_line()
+            lines.append(line)
+        self.reply_lines = lines
+        code, detail = parse_reply(line)
+        self.last_used = time.monotonic()
+        if expect_code and (code not in expect_code):
+            raise FTPError(code, detail)
+        self.log('{0} {1}'.format(code, detail))
+        return code, detail
+
+    def send_command(self, line, expect_code=None):
+        self.ctrl_socket.sendall('{0}\r\n'.format(line).encode('utf-8'))
+        return self.read_reply(expect_code)
+
+    def pipeline(self, commands):
+        # commands are (line, expect_code) pairs that must not depend on each
+        # other; a failed command yields its FTPError in place of the reply
+        results = []
+        sent = 0
+        while len(results) < len(commands):
+            if sent < len(commands) and sent - len(results) < PIPELINE_DEPTH // 2:
+                batch = commands[sent:len(results) + PIPELINE_DEPTH]
+                self.ctrl_socket.sendall(''.join('{0}\r\n'.format(line) for line, _ in batch).encode('utf-8'))
+                sent += len(batch)
+            _, expect_code = commands[len(results)]
+            try:
+                results.append(self.read_reply(expect_code))
+            except FTPError as e:
+                if connection_lost(e):
+                    raise
+                results.append(e)
+        return results
+
+    def sizes(self, paths):
+        results = self.pipeline([('SIZE {0}'.format(path), [213]) for path in paths])
+        return {path: reply_size(result) for path, result in zip(paths, results)
+                if reply_size(result) is not None}
+
+    def mdtms(self, paths):
+        results = self.pipeline([('MDTM {0}'.format(path), [213]) for path in paths])
+        return {path: result[1] for path, result in zip(paths, results)
+                if not isinstance(result, FTPError)}
+
+
+class RangeQueue(object):
+    # byte ranges still to fetch, shared by the segment workers; a worker only
+    # finds it empty once no other worker can hand a failed range back
+    def __init__(self, ranges):
+        self.ranges = ranges
+        self.busy = 0
+        self.cond = threading.Condition()
+
+    def take(self, stopped):
+        with self.cond:
+            while not self.ranges and self.busy and not stopped():
+                self.cond.wait(0.5)
+            if not self.ranges or stopped():
+                return None
+            self.busy += 1
+            return self.ranges.pop(0)
+
+    def done(self, rest=None):
+        with self.cond:
+            self.busy -= 1
+            if rest:
+                self.ranges.append(rest)
+            self.cond.notify_all()
+
+
+class SessionPool(object):
+    def __init__(self, server_info, trans_method, max_idle=4):
+        self.server_info = server_info
+        self.trans_method = trans_method
+        self.max_idle = max_idle
+        self.idle = []
+        # sessions open, idle or in use, and as many as the server allows
+        # once it has refused one
+        self.live = 0
+        self.limit = None
+        self.cond = threading.Condition()
+        self.closed = threading.Event()
+        self.keepalive_thread = threading.Thread(target=self.keepalive_loop, daemon=True)
+        self.keepalive_thread.start()
+
+    def acquire(self):
+        # an idle session or a new one; over the server's limit it waits for
+        # one to come back, and raises only when none is open to wait for
+        with self.cond:
+            while not self.idle and self.limit is not None and self.live >= self.limit:
+                self.cond.wait()
+            session = self.idle.pop() if self.idle else None
+            if session is None:
+                self.live += 1
+        if session is not None:
+            return session
+        session = FTPSession()
+        try:
+            session.open_ctrl(self.server_info, self.trans_method)
+        except (socket.error, FTPError) as e:
+            self.discard(session)
+            with self.cond:
+                if not connection_lost(e) or not self.live:
+                    raise
+                self.limit = self.live
+            return self.acquire()
+        return session
+
+    def release(self, session, broken=False):
+        session.stop = False
+        if not broken and not self.closed.is_set():
+            with self.cond:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append(session)
+                    self.cond.notify()
+                    return
+        self.discard(session)
+
+    def discard(self, session):
+        session.close_ctrl()
+        with self.cond:
+            self.live -= 1
+            self.cond.notify()
+
+    def run(self, operation, retry=True):
+        session = self.acquire()
+        broken = True
+        try:
+            try:
+                result = operation(session)
+            except (socket.error, FTPError) as e:
+                if not connection_lost(e):
+                    broken = False
+                    raise
+                if not retry:
+                    raise
+                session.restore()
+                result = operation(session)
+            broken = False
+            return result
+        finally:
+            self.release(session, broken)
+
+    def keepalive_loop(self):
+        while not self.closed.wait(KEEPALIVE_INTERVAL / 2):
+            now = time.monotonic()
+            with self.cond:
+                stale = [s for s in self.idle if now - s.last_used >= KEEPALIVE_INTERVAL]
+                self.idle = [s for s in self.idle if s not in stale]
+            for session in stale:
+                try:
+                    try:
+                        _, _ = session.com_NOOP()
+                    except (socket.error, FTPError) as e:
+                        if not connection_lost(e):
+                            raise
+                        session.restore()
+                except (socket.error, FTPError):
+                    self.discard(session)
+                    continue
+                self.release(session)
+
+    def close(self):
+        self.closed.set()
+        with self.cond:
+            idle, self.idle = self.idle, []
+        for session in idle:
+            self.discard(session)
+
+
+pools = {}
+pools_lock = threading.Lock()
+
+
+def get_pool(server_info, trans_method, max_idle=None):
+    key = (server_info['hostname'], server_info['port'], server_info['username'], trans_method)
+    with pools_lock:
+        pool = pools.get(key)
+        if pool is None or pool.closed.is_set():
+            pool = pools[key] = SessionPool(server_info, trans_method)
+        if max_idle:
+            pool.max_idle = max(pool.max_idle, max_idle)
+        return pool
+
+
+def close_pools():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
+        pools.clear()
+
+
+def connect(hostname, port=21, username='anonymous', password='', passive=True,
+            on_info=None, on_debug=None, on_progress=None, **profile):
+    # a logged-in session; profile takes the GUI's server_info options
+    # (buffer_size, list_ttl, checksum, verify, compress, ...)
+    server_info = dict(profile, hostname=hostname, port=port, username=username, password=password)
+    session = FTPSession()
+    session.on_info, session.on_debug, session.on_progress = on_info, on_debug, on_progress
+    try:
+        session.open_ctrl(server_info, 0 if passive else 1)
+        session.pwd()
+    except (socket.error, FTPError):
+        session.ctrl_socket.close()
+        raise
+    return session
+
+
+def walk_remote(pool, remote_dir, visit, workers=4, stopped=None):
+    # lists remote_dir and everything below it, several directories at once
+    # over pooled sessions, handing each listing to visit(path, entries) as it
+    # arrives; returns the subdirectories that could not be listed. Failing
+    # to list remote_dir itself raises
+    failed = []
+
+    def walk_dir(path):
+        try:
+            entries = pool.run(lambda session: session.list_dir(path))
+        except FTPError as e:
+            if connection_lost(e) or path == remote_dir:
+                raise
+            failed.append('{0}: {1}'.format(path, e))
+            return []
+        visit(path, entries)
+        return [posixpath.join(path, entry.name) for entry in entries if entry.type == 'dir']
+
+    with ThreadPoolExecutor(workers) as executor:
+        pending = {executor.submit(walk_dir, remote_dir)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for path in future.result():
+                    if not (stopped and stopped()):
+                        pending.add(executor.submit(walk_dir, path))
+    return failed
+
+
+class Mirror(object):
+    # plans and runs a sync of local_dir and remote_dir over pooled sessions;
+    # the GUI queues prepare()'s transfers itself, FTPSession.mirror uses run()
+    def __init__(self, pool, local_dir, remote_dir, direction='get', workers=4, stopped=None):
+        self.pool = pool
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.direction = direction
+        self.workers = workers
+        self.stopped = stopped or (lambda: False)
+        self.remote_files = {}
+        self.remote_dirs = set()
+        self.remote_missing = False
+        self.failed = []
+
+    def plan(self):
+        try:
+            self.failed = walk_remote(self.pool, self.remote_dir, self.visit, self.workers, self.stopped)
+        except FTPError as e:
+            # an upload creates a target that is not there yet
+            if connection_lost(e) or self.direction != 'put':
+                raise
+            self.remote_missing = True
+        self.fill_times()
+        local_files = dict(walk_local(self.local_dir)) if os.path.isdir(self.local_dir) else {}
+        return sync_plan(local_files, self.remote_files, self.direction)
+
+    def visit(self, remote_dir, entries):
+        rel_dir = posixpath.relpath(remote_dir, self.remote_dir)
+        for entry in entries:
+            path = entry.name if rel_dir == '.' else posixpath.join(rel_dir, entry.name)
+            if entry.type == 'dir':
+                self.remote_dirs.add(path)
+            else:
+                self.remote_files[path] = entry
+
+    def fill_times(self):
+        # only MLSD times are exact; LIST cuts them to the minute, or to the
+        # day for older files, so ask MDTM for those and for any missing time,
+        # pipelined. A time MDTM cannot tell is dropped rather than compared
+        # at LIST precision
+        if not self.remote_files:
+            return
+        exact = self.pool.run(lambda session: 'MLST' in session.features)
+        missing = sorted(path for path, entry in self.remote_files.items() if entry.modify is None or not exact)
+        for start in range(0, len(missing), SYNC_MDTM_BATCH):
+            paths = [posixpath.join(self.remote_dir, path) for path in missing[start:start + SYNC_MDTM_BATCH]]
+            times = self.pool.run(lambda session: session.mdtms(paths))
+            for path, remote_path in zip(missing[start:start + SYNC_MDTM_BATCH], paths):
+                modify = parse_mdtm(times[remote_path]) if remote_path in times else None
+                self.remote_files[path] = self.remote_files[path]._replace(modify=modify)
+
+    def prepare(self, plan):
+        # creates the directories the transfers in plan need, on both sides,
+        # and returns the transfers as (action, local_path, remote_path)
+        paths = [self.remote_dir] if self.remote_missing else []
+        paths += [posixpath.join(self.remote_dir, path) for path in missing_parents(plan, self.remote_dirs)]
+        if paths:
+            self.pool.run(lambda session: session.pipeline([('MKD {0}'.format(path), [257]) for path in paths]))
+        transfers = []
+        for action in plan:
+            if action.direction not in ('get', 'put'):
+                continue
+            local_path = os.path.join(self.local_dir, *action.path.split('/'))
+            if action.direction == 'get':
+                os.makedirs(os.path.dirname(local_path), exist_ok=True)
+            transfers.append((action, local_path, posixpath.join(self.remote_dir, action.path)))
+        return transfers
+
+    def run(self, transfers, report=None):
+        # runs prepare()'s transfers over up to workers sessions at once;
+        # report(action, detail) hears of each one, and the failures are
+        # returned as (action, error)
+        failed = []
+
+        def transfer(action, local_path, remote_path):
+            if self.stopped():
+                return
+            try:
+                _, detail = self.pool.run(lambda session: session.transfer(
+                    action.direction, local_path, remote_path, action.size or 0, modify=action.modify))
+            except (socket.error, FTPError) as e:
+                failed.append((action, e))
+                detail = str(e)
+            if report:
+                report(action, detail)
+
+        with ThreadPoolExecutor(self.workers) as executor:
+            for future in [executor.submit(transfer, *item) for item in transfers]:
+                future.result()
+        return failed
@@ -0,0 +1,46 @@
+import unittest
+
+from core import FTPError, hash_commands, hash_result, parse_hash_reply, digest_detail
+
+SHA256 = '9d97c5b3f4a1d0e2b7c6a5f4e3d2c1b0a9f8e7d6c5b4a3f2e1d0c9b8a7f6e5d4'
+MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
+
+
+class HashReplyTest(unittest.TestCase):
+    def test_hash_range_end_is_not_the_digest(self):
+        results = [(350, 'Restarting at 0. End byte range at 12345677'),
+                   (213, 'SHA-256 0-12345677 {0} big.bin'.format(SHA256))]
+        self.assertEqual(hash_result(('HASH', 'sha256'), results), ('sha256', SHA256))
+
+    def test_hash_whole_file(self):
+        results = [(213, 'SHA-256 0-99999999 {0} dir/name with spaces.bin'.format(SHA256))]
+        self.assertEqual(hash_result(('HASH', 'sha256'), results), ('sha256', SHA256))
+
+    def test_hash_reply_fields(self):
+        self.assertEqual(parse_hash_reply('MD5 0-49 {0} a.txt'.format(MD5)), MD5)
+        self.assertEqual(parse_hash_reply('MD5 {0} a.txt'.format(MD5)), None)
+        self.assertEqual(parse_hash_reply('MD5 0-49 not-hex a.txt'), None)
+
+    def test_x_commands(self):
+        self.assertEqual(hash_result(('XMD5', 'md5'), [(250, MD5)]), ('md5', MD5))
+        self.assertEqual(hash_result(('XCRC', 'crc32'), [(250, 'C5D4E1A2')]), ('crc32', 'C5D4E1A2'))
+        self.assertEqual(hash_result(('XSHA256', 'sha256'), [(213, '{0} big.bin'.format(SHA256))]),
+                         ('sha256', SHA256))
+
+    def test_verify_large_file(self):
+        method = ('HASH', 'sha256')
+        self.assertEqual(hash_commands(method, 'big.bin'), [('HASH big.bin', [213])])
+        _, expected = hash_result(method, [(213, 'SHA-256 0-12345677 {0} big.bin'.format(SHA256))])
+        detail = digest_detail('Transfer complete', 'sha256', SHA256.upper(), expected, 'server', 'big.bin')
+        self.assertTrue(detail.endswith(', verified'))
+        with self.assertRaises(FTPError):
+            digest_detail('Transfer complete', 'sha256', MD5, expected, 'server', 'big.bin')
+
+    def test_refused(self):
+        results = [FTPError(504, 'RANG not supported'), (213, 'SHA-256 0-9 {0} a'.format(SHA256))]
+        self.assertEqual(hash_result(('HASH', 'sha256'), results), None)
+        self.assertEqual(hash_result(('XMD5', 'md5'), [(213, 'no digest here')]), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,302 @@
+import os
+import heapq
+import socket
+import posixpath
+import itertools
+import threading
+from PyQt5.QtCore import QThread, pyqtSignal, QObject
+from core import FTPError, scan_local
+from session import get_pool, walk_remote, Mirror
+
+
+class TransferJob(object):
+    ids = itertools.count(1)
+
+    def __init__(self, direction, local_path, remote_path, size, offset=0, modify=None):
+        self.id = next(self.ids)
+        self.direction = direction
+        self.local_path = local_path
+        self.remote_path = remote_path
+        self.size = size
+        self.offset = offset
+        # source mtime, copied onto the target so a later sync sees it unchanged
+        self.modify = modify
+        self.done = offset
+        self.state = 'Queued'
+
+    @property
+    def name(self):
+        return os.path.basename(self.local_path)
+
+
+class JobQueue(object):
+    # jobs by remaining size: get(largest=True) takes the biggest, the others
+    # the smallest, so one lane starts on a huge file at once while small
+    # files stream past it on the rest
+    def __init__(self):
+        self.smallest = []
+        self.largest = []
+        self.taken = set()
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, job):
+        with self.cond:
+            heapq.heappush(self.smallest, (job.size - job.offset, job.id, job))
+            heapq.heappush(self.largest, (job.offset - job.size, job.id, job))
+            self.cond.notify_all()
+
+    def get(self, largest=False):
+        # the next job, or None once the queue is closed and drained
+        with self.cond:
+            heap = self.largest if largest else self.smallest
+            while True:
+                while heap:
+                    _, job_id, job = heapq.heappop(heap)
+                    # every job sits in both heaps; the second pop just forgets it
+                    if job_id in self.taken:
+                        self.taken.discard(job_id)
+                    else:
+                        self.taken.add(job_id)
+                        return job
+                if self.closed:
+                    return None
+                self.cond.wait()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+class TransferWorker(QThread):
+    def __init__(self, parent, jobs, largest=False):
+        self.jobs = jobs
+        self.largest = largest
+        self.session = None
+        self.job = None
+        super(TransferWorker, self).__init__(parent=parent)
+
+    def run(self):
+        transfers = self.parent()
+        while True:
+            job = self.jobs.get(self.largest)
+            if job is None:
+                break
+            self.job = job
+            if transfers.stopped:
+                job.state = 'Cancelled'
+            else:
+                job.state = 'Running'
+                transfers.jobUpdated.emit(job)
+                try:
+                    self.transfer(job)
+                    job.state = 'Cancelled' if transfers.stopped else 'Done'
+                except (socket.error, FTPError) as e:
+                    if transfers.stopped:
+                        job.state = 'Cancelled'
+                    else:
+                        job.state = 'Failed: {0}'.format(e)
+            self.job = None
+            transfers.jobUpdated.emit(job)
+            transfers.job_done()
+
+    def transfer(self, job):
+        def operation(session):
+            self.session = session
+            session.on_progress = self.progress
+            try:
+                session.transfer(job.direction, job.local_path, job.remote_path, job.size, job.offset, job.modify)
+            finally:
+                session.on_progress = None
+                self.session = None
+        # a resumed transfer is not restarted blindly after a reconnect
+        self.parent().pool.run(operation, retry=not job.offset)
+
+    def progress(self, stats):
+        job = self.job
+        if job and not stats['finished']:
+            job.done = stats['done']
+            self.parent().jobUpdated.emit(job)
+
+
+class RemoteWalker(QThread):
+    # walks a remote tree, listing several directories at once over pooled
+    # sessions, and queues every file as soon as its directory is listed
+    def __init__(self, parent, local_dir, remote_dir, listers):
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        self.listers = listers
+        self.failed = []
+        super(RemoteWalker, self).__init__(parent=parent)
+        self.finished.connect(self.deleteLater)
+
+    def run(self):
+        transfers = self.parent()
+        try:
+            self.walk()
+            self.report_failed()
+        except (socket.error, FTPError, OSError) as e:
+            transfers.error.emit(0, '{0}: {1}'.format(self.remote_dir, e))
+        finally:
+            transfers.job_done()
+
+    def walk(self):
+        transfers = self.parent()
+        self.failed = walk_remote(transfers.pool, self.remote_dir, self.visit, self.listers,
+                                  lambda: transfers.stopped)
+
+    def report_failed(self):
+        if self.failed:
+            self.parent().error.emit(0, 'Could not list {0} directories, first: {1}'.format(
+                len(self.failed), self.failed[0]))
+
+    def visit(self, remote_dir, entries):
+        transfers = self.parent()
+        rel_dir = posixpath.relpath(remote_dir, self.remote_dir)
+        local_dir = self.local_dir if rel_dir == '.' else os.path.join(self.local_dir, *rel_dir.split('/'))
+        os.makedirs(local_dir, exist_ok=True)
+        for entry in entries:
+            if entry.type != 'dir' and not transfers.stopped:
+                transfers.add('get', os.path.join(local_dir, entry.name),
+                              posixpath.join(remote_dir, entry.name), entry.size or 0)
+
+
+class SyncWalker(QThread):
+    # compares the local and remote trees and queues only what differs;
+    # a dry run just reports the plan
+    def __init__(self, parent, local_dir, remote_dir, listers, direction, dry_run=False):
+        self.mirror = Mirror(parent.pool, local_dir, remote_dir, direction, listers, lambda: parent.stopped)
+        self.dry_run = dry_run
+        super(SyncWalker, self).__init__(parent=parent)
+        self.finished.connect(self.deleteLater)
+
+    def run(self):
+        transfers = self.parent()
+        mirror = self.mirror
+        try:
+            plan = mirror.plan()
+            if mirror.failed:
+                transfers.error.emit(0, 'Could not list {0} directories, first: {1}'.format(
+                    len(mirror.failed), mirror.failed[0]))
+            transfers.syncPlanned.emit(plan, self.dry_run)
+            if not self.dry_run:
+                for action, local_path, remote_path in mirror.prepare(plan):
+                    if not transfers.stopped:
+                        transfers.add(action.direction, local_path, remote_path, action.size or 0,
+                                      modify=action.modify)
+        except (socket.error, FTPError, OSError) as e:
+            transfers.error.emit(0, '{0}: {1}'.format(mirror.remote_dir, e))
+        finally:
+            transfers.job_done()
+
+
+class LocalWalker(QThread):
+    # walks a local tree level by level: the next level's remote directories
+    # are created with one pipelined batch of MKDs, then the level's files are queued
+    def __init__(self, parent, local_dir, remote_dir):
+        self.local_dir = local_dir
+        self.remote_dir = remote_dir
+        super(LocalWalker, self).__init__(parent=parent)
+        self.finished.connect(self.deleteLater)
+
+    def run(self):
+        transfers = self.parent()
+        try:
+            self.make_dirs([self.remote_dir])
+            level = [(self.local_dir, self.remote_dir)]
+            seen = {os.path.realpath(self.local_dir)}
+            while level and not transfers.stopped:
+                subdirs, files = [], []
+                for local_dir, remote_dir in level:
+                    for entry in scan_local(local_dir):
+                        local_path = os.path.join(local_dir, entry.name)
+                        remote_path = posixpath.join(remote_dir, entry.name)
+                        if entry.type != 'dir':
+                            files.append((local_path, remote_path, entry.size))
+                        elif os.path.realpath(local_path) not in seen:
+                            seen.add(os.path.realpath(local_path))
+                            subdirs.append((local_path, remote_path))
+                self.make_dirs([remote_path for _, remote_path in subdirs])
+                for local_path, remote_path, size in files:
+                    if not transfers.stopped:
+                        transfers.add('put', local_path, remote_path, size)
+                level = subdirs
+        except (socket.error, FTPError, OSError) as e:
+            transfers.error.emit(0, '{0}: {1}'.format(self.local_dir, e))
+        finally:
+            transfers.job_done()
+
+    def make_dirs(self, paths):
+        # directories that already exist answer 550; those results are ignored
+        if paths:
+            self.parent().pool.run(lambda session: session.pipeline(
+                [('MKD {0}'.format(path), [257]) for path in paths]))
+
+
+class TransferQueue(QObject):
+    jobAdded = pyqtSignal(object)
+    jobUpdated = pyqtSignal(object)
+    queueFinished = pyqtSignal()
+    error = pyqtSignal(int, str)
+    syncPlanned = pyqtSignal(list, bool)
+
+    def __init__(self, parent, trans_method, server_info, workers=4):
+        self.server_info = server_info
+        self.trans_method = trans_method
+        self.stopped = False
+        self.pending = 0
+        self.lock = threading.Lock()
+        self.jobs = JobQueue()
+        self.pool = get_pool(server_info, trans_method, workers)
+        super(TransferQueue, self).__init__(parent=parent)
+        # the first worker takes the largest jobs, the others the smallest
+        self.workers = [TransferWorker(self, self.jobs, largest=i == 0) for i in range(workers)]
+
+    def add(self, direction, local_path, remote_path, size, offset=0, modify=None):
+        job = TransferJob(direction, local_path, remote_path, size, offset, modify)
+        with self.lock:
+            self.pending += 1
+        self.jobAdded.emit(job)
+        self.jobs.put(job)
+        for worker in self.workers:
+            if not worker.isRunning():
+                worker.start()
+        return job
+
+    def get_tree(self, local_dir, remote_dir):
+        # the walk counts as a pending job so the queue is not reported
+        # finished while files are still being discovered
+        with self.lock:
+            self.pending += 1
+        walker = RemoteWalker(self, local_dir, remote_dir, len(self.workers))
+        walker.start()
+        return walker
+
+    def put_tree(self, local_dir, remote_dir):
+        with self.lock:
+            self.pending += 1
+        walker = LocalWalker(self, local_dir, remote_dir)
+        walker.start()
+        return walker
+
+    def sync(self, local_dir, remote_dir, direction, dry_run=False):
+        with self.lock:
+            self.pending += 1
+        walker = SyncWalker(self, local_dir, remote_dir, len(self.workers), direction, dry_run)
+        walker.start()
+        return walker
+
+    def job_done(self):
+        with self.lock:
+            self.pending -= 1
+            finished = self.pending == 0
+        if finished:
+            self.queueFinished.emit()
+
+    def stop(self):
+        self.stopped = True
+        for worker in self.workers:
+            if worker.session:
+                worker.session.stop = True
+        self.jobs.close()